@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import atexit
+import socket
+import argparse
+import tempfile
+import warnings
+import contextlib
+import subprocess
+import collections
+from pathlib import Path
+
+import psutil
+
+from .monitor import ResourceMonitor
+
+
+Benchmark = collections.namedtuple('Benchmark', 'name func suite setup warmup repeat')
+
+# registered benchmarks by name
+benchmarks = {}
+
+def benchmark(func=None, *, name=None, suite='default', setup=None, warmup=1, repeat=5):
+    """Decorator that registers function as a benchmark."""
+    def decorator(f):
+        n = f.__name__ if name is None else name
+        benchmarks[n] = Benchmark(n, f, suite, setup, warmup, repeat)
+        return f
+    return decorator if func is None else decorator(func)
+
+def _io_bytes():
+    """Return total (read, write) bytes of this process, or (None, None) if not available."""
+    try:
+        c = psutil.Process().io_counters()
+    except (AttributeError, NotImplementedError, psutil.AccessDenied):
+        return None, None
+    return getattr(c, 'read_chars', c.read_bytes), getattr(c, 'write_chars', c.write_bytes)
+
+def _measure(func, args):
+    """Execute `func(*args)` once and return dict of measurements."""
+    mon = ResourceMonitor(interval=0.01, backend='thread')
+    r0, w0 = _io_bytes()
+    mon.start()
+    c0 = time.process_time()
+    t0 = time.perf_counter()
+    func(*args)
+    t1 = time.perf_counter()
+    c1 = time.process_time()
+    with warnings.catch_warnings():
+        # very short executions can finish before the first sample
+        warnings.simplefilter('ignore')
+        mon.stop()
+    r1, w1 = _io_bytes()
+    rss = psutil.Process().memory_info().rss
+    if mon.df is not None:
+        rss = max(rss, int(mon.df['memory'].max()))
+    return {'wall': t1 - t0,
+            'cpu': c1 - c0,
+            'peak_rss': rss,
+            'read_bytes': None if r0 is None else r1 - r0,
+            'write_bytes': None if w0 is None else w1 - w0}
+
+def run_benchmark(b, warmup=None, repeat=None):
+    """Run benchmark `b` (object or name) and return dict of lists of measurements from every repeat."""
+    if isinstance(b, str):
+        b = benchmarks[b]
+    warmup = b.warmup if warmup is None else warmup
+    repeat = b.repeat if repeat is None else repeat
+    res = collections.defaultdict(list)
+    for i in range(warmup + repeat):
+        args = () if b.setup is None else b.setup()
+        m = _measure(b.func, args)
+        if i >= warmup:
+            for k, v in m.items():
+                res[k].append(v)
+    return dict(res)
+
+def _git_commit(path='.'):
+    """Return (commit hash, dirty flag) of git repo at `path`, or (None, None) outside of a repo."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True, text=True, check=True)
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                cwd=path, capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.stdout.strip(), bool(status.stdout.strip())
+
+
+class BenchHistory:
+    """Benchmark results stored in JSON lines file."""
+
+    def __init__(self, path='.bench/history.jsonl'):
+        self.path = Path(path)
+
+    def __repr__(self):
+        return f'BenchHistory("{self.path}")'
+
+    def append(self, record):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def records(self, commit=None, benchmark=None):
+        """Return list of records, optionally filtered by commit hash prefix and benchmark name."""
+        if not self.path.exists():
+            return []
+        res = []
+        with open(self.path) as f:
+            for line in f:
+                r = json.loads(line)
+                if commit is not None and not (r['commit'] or '').startswith(commit):
+                    continue
+                if benchmark is not None and r['benchmark'] != benchmark:
+                    continue
+                res.append(r)
+        return res
+
+    def commits(self):
+        """Return list of commits in history, in order of their first run."""
+        return list(dict.fromkeys(r['commit'] for r in self.records()))
+
+def run(names=None, suite=None, history=None, commit=None, warmup=None, repeat=None, verbose=True):
+    """Run benchmarks, save results to `history` and return dataframe with medians of measurements.
+    Benchmarks are selected by list of `names`, or by `suite` name, or all registered benchmarks are run.
+    `commit` overrides git commit of the current directory.
+    Pass `history=False` to not save results.
+    """
+    import pandas as pd
+    if history is None:
+        history = BenchHistory()
+    if commit is None:
+        commit, dirty = _git_commit()
+    else:
+        dirty = False
+    if names is None:
+        names = [n for n, b in benchmarks.items() if suite is None or b.suite == suite]
+    rows = {}
+    for name in names:
+        b = benchmarks[name]
+        if verbose:
+            print(f'Benchmark "{name}"...', end=' ', flush=True)
+        res = run_benchmark(b, warmup, repeat)
+        record = {'benchmark': name, 'suite': b.suite, 'commit': commit, 'dirty': dirty,
+                  'time': time.time(), 'host': socket.gethostname(), **res}
+        if history:
+            history.append(record)
+        rows[name] = {k: _median(v) for k, v in res.items()}
+        if verbose:
+            print(f'{rows[name]["wall"]:.3f} seconds')
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+def _median(xs):
+    xs = sorted(x for x in xs if x is not None)
+    if not xs:
+        return None
+    n = len(xs)
+    return xs[n // 2] if n % 2 else (xs[n // 2 - 1] + xs[n // 2]) / 2
+
+def _resolve_commit(ref, history):
+    """Return full commit hash of `ref`, which is hash prefix in history or git revision."""
+    for c in history.commits():
+        if c is not None and c.startswith(ref):
+            return c
+    try:
+        p = subprocess.run(['git', 'rev-parse', ref], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        raise ValueError(f'Commit "{ref}" not found in benchmark history or git repo.')
+    return p.stdout.strip()
+
+def compare(baseline=None, current=None, history=None, threshold=0.1, metrics=('wall', 'cpu', 'peak_rss')):
+    """Compare benchmark results between two commits and return dataframe indexed by (benchmark, metric).
+    By default, `current` is the last commit in history and `baseline` is the commit before it.
+    Latest run of every benchmark at each commit is used.
+    """
+    import pandas as pd
+    if history is None:
+        history = BenchHistory()
+    commits = history.commits()
+    if not commits:
+        raise ValueError(f'Benchmark history "{history.path}" is empty.')
+    current = commits[-1] if current is None else _resolve_commit(current, history)
+    if baseline is None:
+        i = commits.index(current) if current in commits else len(commits)
+        if i < 1:
+            raise ValueError('No baseline commit in benchmark history.')
+        baseline = commits[i - 1]
+    else:
+        baseline = _resolve_commit(baseline, history)
+    base = {r['benchmark']: r for r in history.records(baseline)}
+    cur = {r['benchmark']: r for r in history.records(current)}
+    rows = []
+    for name in base.keys() & cur.keys():
+        for m in metrics:
+            b = [x for x in base[name][m] if x is not None]
+            c = [x for x in cur[name][m] if x is not None]
+            if not b or not c:
+                continue
+            bm, cm = _median(b), _median(c)
+            change = cm / bm - 1 if bm else 0.0
+            noise = max(threshold, (max(b) - min(b)) / 2 / bm if bm else 0.0)
+            rows.append({'benchmark': name, 'metric': m, 'baseline': bm, 'current': cm,
+                         'change': change, 'noise': noise, 'regression': change > noise})
+    df = pd.DataFrame(rows, columns=['benchmark', 'metric', 'baseline', 'current', 'change', 'noise', 'regression'])
+    df.attrs['baseline'] = baseline
+    df.attrs['current'] = current
+    return df.sort_values(['benchmark', 'metric']).set_index(['benchmark', 'metric'])
+
+_test_slowdown = 1
+
+@benchmark(suite='_test', warmup=0, repeat=3)
+def _test_bench_sleep():
+    time.sleep(0.05 * _test_slowdown)
+
+@benchmark(suite='_test', warmup=0, repeat=3, setup=lambda: (10**6,))
+def _test_bench_alloc(n):
+    x = [0] * n
+    del x
+
+def test_bench():
+    global _test_slowdown
+    with tempfile.TemporaryDirectory() as d:
+        h = BenchHistory(Path(d) / 'history.jsonl')
+        df = run(suite='_test', history=h, commit='a' * 40, verbose=False)
+        assert set(df.index) == {'_test_bench_sleep', '_test_bench_alloc'}
+        assert df.loc['_test_bench_sleep', 'wall'] >= 0.05
+        assert len(h.records(benchmark='_test_bench_alloc')[0]['wall']) == 3
+        _test_slowdown = 3
+        try:
+            run(suite='_test', history=h, commit='b' * 40, verbose=False)
+        finally:
+            _test_slowdown = 1
+        assert h.commits() == ['a' * 40, 'b' * 40]
+        cmp = compare(history=h)
+        assert cmp.attrs['baseline'] == 'a' * 40
+        assert cmp.loc[('_test_bench_sleep', 'wall'), 'regression']
+        cmp = compare('b', 'a', history=h)
+        assert not cmp.loc[('_test_bench_sleep', 'wall'), 'regression']
+
+
+_bench_tmp = None
+
+def _tmp_dir():
+    """Return temporary directory for benchmark files, removed at exit."""
+    global _bench_tmp
+    if _bench_tmp is None:
+        _bench_tmp = tempfile.mkdtemp(prefix='reseng-bench-')
+        atexit.register(shutil.rmtree, _bench_tmp, ignore_errors=True)
+    return Path(_bench_tmp)
+
+def _setup_simplecache(hit):
+    import numpy as np
+    import pandas as pd
+    from .caching import simplecache
+
+    d = tempfile.mkdtemp(dir=_tmp_dir())
+    @simplecache(f'{d}/frame.pkl', lock=False)
+    def frame():
+        rng = np.random.default_rng(0)
+        return pd.DataFrame({'x': np.arange(10**6), 'y': rng.random(10**6), 'z': rng.integers(0, 100, 10**6)})
+    if hit:
+        frame()
+    return (frame,)
+
+@benchmark(suite='reseng', setup=lambda: _setup_simplecache(False))
+def simplecache_miss(frame):
+    frame()
+
+@benchmark(suite='reseng', setup=lambda: _setup_simplecache(True))
+def simplecache_hit(frame):
+    frame()
+
+def _setup_tag_invalid_values():
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(0)
+    x = rng.normal(50, 30, 10**7)
+    x[rng.integers(0, len(x), 10**5)] = np.nan
+    return (pd.Series(x),)
+
+@benchmark(suite='reseng', setup=_setup_tag_invalid_values)
+def tag_invalid_values_10m(ser):
+    from .util import tag_invalid_values
+    tag_invalid_values(ser, notna=True, ge=0, lt=100)
+
+def _setup_nb2mod(ncells=2000):
+    import nbformat
+    from .nbd import Nbd
+
+    root = Path(tempfile.mkdtemp(dir=_tmp_dir()))
+    (root / 'pkg').mkdir()
+    (root / 'nbs').mkdir()
+    (root / 'nbs' / 'pkg').symlink_to('../pkg')
+    nb = nbformat.v4.new_notebook()
+    for i in range(ncells):
+        src = f'from pkg.mod{i % 10} import func{i}\n\ndef f{i}(x):\n    return func{i}(x) + {i}\n'
+        nb.cells.append(nbformat.v4.new_code_cell(src, metadata={'tags': ['nbd-module']}))
+        nb.cells.append(nbformat.v4.new_markdown_cell(f'Cell {i} description.'))
+    nbformat.write(nb, root / 'nbs' / 'big.ipynb')
+    return (Nbd('pkg', root),)
+
+@benchmark(suite='reseng', setup=_setup_nb2mod)
+def nb2mod_large(nbd):
+    with contextlib.redirect_stdout(io.StringIO()):
+        nbd.nb2mod('big.ipynb')
+
+def test_suite():
+    df = run(suite='reseng', history=False, warmup=0, repeat=1, verbose=False)
+    assert set(df.index) == {'simplecache_miss', 'simplecache_hit', 'tag_invalid_values_10m', 'nb2mod_large'}
+    assert (df['wall'] > 0).all()
+
+
+# maximum import time in seconds
+import_budgets = {
+    'reseng.caching': 0.1,
+    'reseng.monitor': 0.15,
+    'reseng.nbd': 0.05,
+    'reseng.util': 0.05,
+    'reseng.index': 0.05,
+}
+
+# modules that are slow to import and must not be loaded by package modules at import time
+lazy_imports = ['numpy', 'pandas', 'requests', 'nbformat', 'nbconvert', 'asyncio', 'sqlite3', 'concurrent.futures']
+
+def import_time(module, repeat=3):
+    """Return dict of cumulative import times in seconds of all modules loaded by `import module`."""
+    with tempfile.TemporaryDirectory() as d:
+        env = dict(os.environ, PYTHONPYCACHEPREFIX=d)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        best = {}
+        for i in range(repeat + 1):
+            r = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               capture_output=True, text=True, env=env)
+            if r.returncode != 0:
+                raise ImportError(f'Failed to import "{module}":\n{r.stderr}')
+            if i == 0:
+                continue
+            for line in r.stderr.splitlines():
+                if not line.startswith('import time:'):
+                    continue
+                _, cumulative, name = line[12:].split('|')
+                if not cumulative.strip().isdigit():
+                    continue  # header line
+                name = name.strip()
+                t = int(cumulative) / 1e6
+                best[name] = min(best.get(name, t), t)
+    return best
+
+def test_import_time():
+    for module, budget in import_budgets.items():
+        times = import_time(module)
+        heavy = [m for m in lazy_imports if m in times]
+        assert not heavy, f'"{module}" imports {heavy}'
+        assert times[module] < budget, f'"{module}" import took {times[module]:.3f} seconds, budget is {budget}'
+        print(f'{module}: {times[module] * 1000:.1f} ms')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m reseng.bench', description='Benchmark runner.')
+    parser.add_argument('--history', default='.bench/history.jsonl', help='benchmark history file')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('run', help='run benchmarks and save results')
+    p.add_argument('--suite', help='only run benchmarks from this suite')
+    p.add_argument('--repeat', type=int, help='override number of repeats')
+    p.add_argument('names', nargs='*', help='names of benchmarks to run')
+    p = sub.add_parser('compare', help='compare results between commits')
+    p.add_argument('--baseline', help='baseline commit, default is the one before current')
+    p.add_argument('--current', help='current commit, default is the last one in history')
+    p.add_argument('--threshold', type=float, default=0.1, help='minimum relative change to report')
+    args = parser.parse_args(argv)
+    history = BenchHistory(args.history)
+    if args.command == 'run':
+        df = run(args.names or None, args.suite, history, repeat=args.repeat)
+        print(df.to_string())
+        return 0
+    df = compare(args.baseline, args.current, history, args.threshold)
+    print(f'Baseline: {df.attrs["baseline"]}, current: {df.attrs["current"]}')
+    print(df.to_string())
+    return int(df['regression'].any())
+
+def test_cli():
+    with tempfile.TemporaryDirectory() as d:
+        h = f'{d}/history.jsonl'
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert main(['--history', h, 'run', '--repeat', '1', '_test_bench_sleep']) == 0
+        assert BenchHistory(h).records()[0]['benchmark'] == '_test_bench_sleep'
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+def test_all():
+    test_bench()
+    test_suite()
+    test_import_time()
+    test_cli()
+
@@ -1,32 +1,221 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
+import sys
+import copy
+import types
+import atexit
+import time
+import json
+import mmap
+import uuid
+import struct
+import socket
+import logging
 import pathlib
 import pickle
+import hashlib
+import inspect
 import functools
+import warnings
+import threading
+import collections
+import contextlib
+import itertools
 from typing import Union
 
+log = logging.getLogger(__name__)
 
-def simplecache(path: Union[str, pathlib.Path]):
+
+def simplecache(path: Union[str, pathlib.Path], key: str = 'format', serializer='pickle',
+                memory=None, memory_policy: str = 'share', lock: bool = True, lock_timeout: float = None,
+                manager=None, background: bool = False):
     """Pickle function's returned value. Function returns pickled value if it exists.
     If `path` is str, may use "{}" placeholders to be filled from function arguments.
     Placeholders must be consistent with function call arguments ({} for args, {...} for kwargs).
+    Named placeholders are also filled from positional arguments and defaults.
+
+    With `key="hash"`, `path` is a directory and cache file name is made from function name
+    and a hash of normalized call arguments, function source code and closure values.
+    Path of the cache file for given arguments is returned by `func.cache_path(*args, **kwargs)`.
+
+    `serializer` is a name from `serializers` registry, a serializer object or "auto",
+    which stores dataframes in columnar format and everything else with pickle.
+    Lazy handle to cached value, e.g. to only read some of dataframe columns,
+    is returned by `func.entry(*args, **kwargs)`.
+
+    `memory` enables in-process cache in front of disk: True to use shared `memory_cache`, or a `MemoryCache` object.
+    `memory_policy` controls values returned from memory: "share" returns the cached object itself,
+    "copy" returns a deep copy and "readonly" returns a value that can not be used to modify the cached one.
+
+    With `lock`, only one process computes a missing value, while others wait for it up to `lock_timeout` seconds.
+    Values are written to a temporary file, which is then renamed, so a partially written file is never read.
+
+    `manager` is a `CacheManager` that records usage statistics and enforces disk budget.
+
+    `func.map(grid, workers=N)` evaluates function over a grid of arguments, computing only missing values in parallel.
+
+    With `background`, computed value is returned immediately and written to disk in a background thread.
+    Use `flush()` to wait for pending writes. Coroutine functions are supported.
     """
+    if key not in ('format', 'hash'):
+        raise ValueError(f'Unknown cache key mode "{key}".')
+    if memory_policy not in ('share', 'copy', 'readonly'):
+        raise ValueError(f'Unknown memory policy "{memory_policy}".')
+    if memory is True:
+        memory = memory_cache
+    elif memory is False:
+        memory = None
+    if serializer != 'auto' and not hasattr(serializer, 'dump'):
+        serializer = serializers[serializer]
     def wrapper(func):
-        @functools.wraps(func)
-        def wrapped(*args, **kwargs):
+        sig = inspect.signature(func)
+        func_hash = None
+        def cache_path(*args, **kwargs):
+            nonlocal func_hash
             p = path
+            try:
+                bound = sig.bind(*args, **kwargs)
+                bound.apply_defaults()
+            except TypeError:
+                if key == 'hash':
+                    raise
+                bound = None
             if isinstance(p, str):
-                p = pathlib.Path(p.format(*args, **kwargs))
-            if p.exists():
-                print(f'Reading {func.__name__}() cached result from "{p}".')
-                return pickle.load(p.open('rb'))
+                named = {} if bound is None else bound.arguments
+                p = p.format(*args, **{**named, **kwargs})
+            p = pathlib.Path(p)
+            if key == 'hash':
+                if func_hash is None:
+                    func_hash = _func_hash(func)
+                h = hashlib.blake2b(func_hash.encode(), digest_size=16)
+                _hash_update(h, dict(bound.arguments))
+                p = p / f'{func.__name__}-{h.hexdigest()}'
+            return p
+
+        def read(p):
+            t0 = time.perf_counter()
+            res = _load(p)
+            dt = time.perf_counter() - t0
+            log.info(f'Read {func.__name__}() cached result from "{p}" in {dt:.2f} seconds.')
+            if manager is not None:
+                manager.record_hit(func.__qualname__, p, dt)
+            return res
+
+        def store(p, res, compute_time, flock):
+            """Write computed value to cache file and release file lock."""
+            def write():
+                try:
+                    t0 = time.perf_counter()
+                    _atomic_dump(res, p, serializer)
+                    dt = time.perf_counter() - t0
+                    log.info(f'Wrote {func.__name__}() result to cache at "{p}", '
+                             f'computed in {compute_time:.2f} and written in {dt:.2f} seconds.')
+                    if manager is not None:
+                        manager.record_miss(func.__qualname__, p, compute_time, dt)
+                    if background and memory is not None:
+                        # update file stamp of memory entry
+                        memory.put(p, res)
+                finally:
+                    if flock is not None:
+                        flock.release()
+            if background:
+                _submit_write(p, res, write)
             else:
-                res = func(*args, **kwargs)
-                print(f'Writing {func.__name__}() result to cache at "{p}".')
+                write()
+
+        def lookup(p):
+            """Return value from memory, pending background write or disk, or `_MISSING`.
+            Second returned value is True if value came from memory.
+            """
+            if memory is not None:
+                res = memory.get(p)
+                if res is not _MISSING:
+                    if manager is not None:
+                        manager.record_memory_hit(func.__qualname__, p)
+                    return res, True
+            res = _pending_value(p)
+            if res is not _MISSING:
+                return res, False
+            if p.exists():
+                return read(p), False
+            return _MISSING, False
+
+        def finish(p, res, in_memory=False):
+            if memory is not None:
+                if not in_memory:
+                    memory.put(p, res)
+                res = _memory_return(res, memory_policy)
+            return res
+
+        if inspect.iscoroutinefunction(func):
+            import asyncio
+            inflight = {}
+
+            async def acompute(p, args, kwargs):
+                res, in_memory = await asyncio.to_thread(lookup, p)
+                if res is not _MISSING:
+                    return res, in_memory
                 p.parent.mkdir(parents=True, exist_ok=True)
-                pickle.dump(res, p.open('wb'), protocol=5)
-                return res
+                flock = FileLock(_lock_path(p), lock_timeout) if lock else None
+                if flock is not None:
+                    await asyncio.to_thread(flock.acquire)
+                try:
+                    if p.exists():
+                        # computed by another process while we waited for the lock
+                        return await asyncio.to_thread(read, p), False
+                    t0 = time.perf_counter()
+                    res = await func(*args, **kwargs)
+                    # lock is released by store(), also if it fails
+                    store_lock, flock = flock, None
+                    await asyncio.to_thread(store, p, res, time.perf_counter() - t0, store_lock)
+                    return res, False
+                finally:
+                    if flock is not None:
+                        flock.release()
+
+            @functools.wraps(func)
+            async def awrapped(*args, **kwargs):
+                p = cache_path(*args, **kwargs)
+                # concurrent awaiters of the same value share one task
+                k = (asyncio.get_running_loop(), str(p))
+                task = inflight.get(k)
+                if task is None:
+                    task = asyncio.ensure_future(acompute(p, args, kwargs))
+                    inflight[k] = task
+                    task.add_done_callback(lambda _: inflight.pop(k, None))
+                res, in_memory = await asyncio.shield(task)
+                return finish(p, res, in_memory)
+            awrapped.cache_path = cache_path
+            return awrapped
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            p = cache_path(*args, **kwargs)
+            res, in_memory = lookup(p)
+            if res is _MISSING:
+                p.parent.mkdir(parents=True, exist_ok=True)
+                flock = FileLock(_lock_path(p), lock_timeout) if lock else None
+                if flock is not None:
+                    flock.acquire()
+                try:
+                    if p.exists():
+                        # computed by another process while we waited for the lock
+                        res = read(p)
+                    else:
+                        t0 = time.perf_counter()
+                        res = func(*args, **kwargs)
+                        # lock is released by store(), also if it fails
+                        store_lock, flock = flock, None
+                        store(p, res, time.perf_counter() - t0, store_lock)
+                finally:
+                    if flock is not None:
+                        flock.release()
+            return finish(p, res, in_memory)
+        wrapped.cache_path = cache_path
+        wrapped.entry = lambda *args, **kwargs: CacheEntry(wrapped, args, kwargs, cache_path(*args, **kwargs))
+        wrapped.map = functools.partial(_cache_map, wrapped)
         return wrapped
     return wrapper
 
@@ -71,6 +260,1369 @@ def test_simplecache():
         shutil.rmtree(p0)
 
 
+def _hash_update(h, x, _seen=None):
+    """Feed value `x` into hashlib object `h`.
+    Arrays and pandas objects are hashed by data buffers, containers recursively, other objects by pickle.
+    """
+    np = sys.modules.get('numpy')
+    pd = sys.modules.get('pandas')
+    t = type(x)
+    h.update(f'<{t.__module__}.{t.__qualname__}>'.encode())
+    if x is None or isinstance(x, (bool, int, float, complex, str)):
+        h.update(repr(x).encode())
+    elif isinstance(x, (bytes, bytearray)):
+        h.update(x)
+    elif isinstance(x, pathlib.PurePath):
+        h.update(str(x).encode())
+    elif isinstance(x, (list, tuple)):
+        h.update(str(len(x)).encode())
+        for v in x:
+            _hash_update(h, v, _seen)
+    elif isinstance(x, dict):
+        # order-insensitive, like dict equality
+        items = []
+        for k, v in x.items():
+            hk = hashlib.blake2b(digest_size=16)
+            _hash_update(hk, k, _seen)
+            items.append((hk.digest(), v))
+        h.update(str(len(items)).encode())
+        for k, v in sorted(items, key=lambda kv: kv[0]):
+            h.update(k)
+            _hash_update(h, v, _seen)
+    elif isinstance(x, (set, frozenset)):
+        digests = []
+        for v in x:
+            hv = hashlib.blake2b(digest_size=16)
+            _hash_update(hv, v, _seen)
+            digests.append(hv.digest())
+        for d in sorted(digests):
+            h.update(d)
+    elif np is not None and isinstance(x, np.ndarray):
+        h.update(f'{x.dtype.str}{x.shape}'.encode())
+        if x.dtype.hasobject:
+            _hash_update(h, x.tolist(), _seen)
+        else:
+            h.update(np.ascontiguousarray(x).reshape(-1).view(np.uint8))
+    elif pd is not None and isinstance(x, pd.DataFrame):
+        _hash_update(h, x.columns, _seen)
+        _hash_update(h, x.index, _seen)
+        for i in range(x.shape[1]):
+            col = x.iloc[:, i]
+            h.update(str(col.dtype).encode())
+            _hash_update(h, _pandas_hashable(col), _seen)
+    elif pd is not None and isinstance(x, pd.Series):
+        _hash_update(h, x.name, _seen)
+        _hash_update(h, x.index, _seen)
+        h.update(str(x.dtype).encode())
+        _hash_update(h, _pandas_hashable(x), _seen)
+    elif pd is not None and isinstance(x, pd.RangeIndex):
+        _hash_update(h, (x.name, x.start, x.stop, x.step), _seen)
+    elif pd is not None and isinstance(x, pd.Index):
+        _hash_update(h, list(x.names), _seen)
+        h.update(str(x.dtype).encode())
+        _hash_update(h, _pandas_hashable(x), _seen)
+    elif inspect.isfunction(x):
+        h.update(_func_hash(x, _seen).encode())
+    elif inspect.ismodule(x):
+        h.update(x.__name__.encode())
+    elif isinstance(x, type):
+        h.update(f'{x.__module__}.{x.__qualname__}'.encode())
+    else:
+        try:
+            h.update(pickle.dumps(x, protocol=5))
+        except Exception as e:
+            raise TypeError(f'Can not hash value of type "{t.__qualname__}" for cache key.') from e
+
+def _pandas_hashable(x):
+    """Return numpy array with data of pandas Series or Index suitable for buffer hashing."""
+    import numpy as np
+    import pandas as pd
+    if isinstance(x.dtype, np.dtype) and not x.dtype.hasobject:
+        return x.to_numpy()
+    # object, string, categorical and other extension types
+    return pd.util.hash_pandas_object(x, index=False).to_numpy()
+
+def _func_hash(func, _seen=None):
+    """Return hex digest of function source code and values of its closure variables."""
+    _seen = set() if _seen is None else _seen
+    if id(func) in _seen:
+        return 'recursion'
+    _seen.add(id(func))
+    func = inspect.unwrap(func)
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        h.update(inspect.getsource(func).encode())
+    except (OSError, TypeError):
+        # source not available, e.g. function defined in interactive shell
+        code = func.__code__
+        h.update(code.co_code)
+        _hash_update(h, [c for c in code.co_consts if not inspect.iscode(c)], _seen)
+    for name, cell in zip(func.__code__.co_freevars, func.__closure__ or ()):
+        h.update(name.encode())
+        try:
+            value = cell.cell_contents
+        except ValueError:
+            # cell is not yet assigned
+            continue
+        _hash_update(h, value, _seen)
+    return h.hexdigest()
+
+def test_simplecache_hash():
+    import tempfile
+    import numpy as np
+    import pandas as pd
+
+    with tempfile.TemporaryDirectory() as d:
+        calls = []
+        @simplecache(d, key='hash')
+        def test(df, x=1):
+            calls.append(x)
+            return df['a'].sum() + x
+
+        df = pd.DataFrame({'a': np.arange(1000), 'b': list('ab') * 500})
+        assert test(df) == 499501
+        assert test(df, x=1) == 499501
+        assert test(df=df, x=1) == 499501
+        assert len(calls) == 1
+        assert test(df, 2) == 499502
+        df2 = df.copy()
+        df2.loc[0, 'b'] = 'c'
+        assert test.cache_path(df2) != test.cache_path(df)
+        assert test.cache_path(df.copy()) == test.cache_path(df)
+        assert len(calls) == 2
+
+        # closure value is part of the key
+        def make(k):
+            @simplecache(d, key='hash')
+            def test(x):
+                return x * k
+            return test
+        assert make(2).cache_path(1) != make(3).cache_path(1)
+        assert make(2).cache_path(1) == make(2).cache_path(1)
+
+
+class PickleSerializer:
+    """Any object, pickled with protocol 5."""
+    name = 'pickle'
+    magic = b'\x80'
+
+    def match(self, obj):
+        return True
+
+    def dump(self, obj, path):
+        with open(path, 'wb') as f:
+            pickle.dump(obj, f, protocol=5)
+
+    def load(self, path, columns=None):
+        with open(path, 'rb') as f:
+            obj = pickle.load(f)
+        return obj if columns is None else obj[columns]
+
+class FeatherSerializer:
+    """Pandas dataframe in Arrow IPC file, read with memory map and column selection."""
+    name = 'feather'
+    magic = b'ARROW1'
+
+    def __init__(self, compression='uncompressed'):
+        # compressed buffers can not be used directly from memory map
+        self.compression = compression
+
+    def match(self, obj):
+        pd = sys.modules.get('pandas')
+        if pd is None or not isinstance(obj, pd.DataFrame):
+            return False
+        if not all(isinstance(c, str) for c in obj.columns):
+            return False
+        try:
+            import pyarrow
+        except ImportError:
+            return False
+        return True
+
+    def dump(self, obj, path):
+        from pyarrow import feather
+        feather.write_feather(obj, path, compression=self.compression)
+
+    def load(self, path, columns=None):
+        from pyarrow import feather
+        return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+
+class ParquetSerializer(FeatherSerializer):
+    """Pandas dataframe in Parquet file, read with column selection."""
+    name = 'parquet'
+    magic = b'PAR1'
+
+    def __init__(self, compression='snappy'):
+        self.compression = compression
+
+    def dump(self, obj, path):
+        obj.to_parquet(path, engine='pyarrow', compression=self.compression)
+
+    def load(self, path, columns=None):
+        import pandas as pd
+        return pd.read_parquet(path, engine='pyarrow', columns=columns, memory_map=True)
+
+serializers = {}
+
+def register_serializer(serializer):
+    """Add serializer to registry, making it available by name and for format detection on load."""
+    serializers[serializer.name] = serializer
+
+register_serializer(PickleSerializer())
+register_serializer(FeatherSerializer())
+register_serializer(ParquetSerializer())
+
+def _detect_serializer(path):
+    """Return registered serializer with longest magic prefix matching start of the file."""
+    with open(path, 'rb') as f:
+        head = f.read(16)
+    found = [s for s in serializers.values() if head.startswith(s.magic)]
+    if not found:
+        raise ValueError(f'Unknown format of cache file "{path}".')
+    return max(found, key=lambda s: len(s.magic))
+
+def _load(path, columns=None):
+    return _detect_serializer(path).load(path, columns)
+
+def _dump(obj, path, serializer):
+    """Write `obj` to `path` and return serializer that was used."""
+    if serializer != 'auto':
+        serializer.dump(obj, path)
+        return serializer
+    columnar = serializers['feather']
+    if columnar.match(obj):
+        try:
+            columnar.dump(obj, path)
+            return columnar
+        except Exception as e:
+            warnings.warn(f'Could not write dataframe in columnar format, falling back to pickle: {e}')
+    serializers['pickle'].dump(obj, path)
+    return serializers['pickle']
+
+class CacheEntry:
+    """Lazy handle to cached value of a function call."""
+    def __init__(self, func, args, kwargs, path):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.path = path
+
+    def __repr__(self):
+        return f'CacheEntry("{self.path}")'
+
+    def exists(self):
+        return self.path.exists()
+
+    def load(self, columns=None):
+        """Return cached value, calling the function first if entry does not exist.
+        `columns` selects a subset of dataframe columns to read.
+        """
+        if not self.exists():
+            res = self.func(*self.args, **self.kwargs)
+            return res if columns is None else res[columns]
+        return _load(self.path, columns)
+
+def test_simplecache_serializers():
+    import tempfile
+    import numpy as np
+    import pandas as pd
+
+    df = pd.DataFrame({'a': np.arange(10), 'b': np.linspace(0, 1, 10), 'c': list('abcdefghij')},
+                      index=pd.Index(range(100, 110), name='i'))
+    with tempfile.TemporaryDirectory() as d:
+        for ser in ['pickle', 'feather', 'parquet', 'auto']:
+            @simplecache(d + '/' + ser, serializer=ser)
+            def test():
+                return df
+            pd.testing.assert_frame_equal(test(), df)
+            pd.testing.assert_frame_equal(test(), df)
+            e = test.entry()
+            assert e.exists()
+            pd.testing.assert_frame_equal(e.load(columns=['b', 'c']), df[['b', 'c']])
+        assert open(d + '/auto', 'rb').read(6) == b'ARROW1'
+
+        # non-dataframe values are pickled in "auto" mode
+        @simplecache(d + '/{}', serializer='auto')
+        def test(x):
+            return [x]
+        assert test(1) == [1]
+        assert test(1) == [1]
+        assert open(d + '/1', 'rb').read(1) == b'\x80'
+
+
+class OutOfBandSerializer:
+    """Any object, pickled with protocol 5 with buffers stored out-of-band and loaded with memory map."""
+    name = 'pickle-oob'
+    magic = b'RSPKLOOB'
+    align = 64
+
+    def match(self, obj):
+        return True
+
+    def dump(self, obj, path):
+        buffers = []
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        chunks = [memoryview(data)] + [b.raw() for b in buffers]
+        layout = []
+        offset = 0
+        for c in chunks:
+            layout.append((offset, c.nbytes))
+            offset += -(-c.nbytes // self.align) * self.align
+        header = json.dumps(layout).encode()
+        start = -(-(len(self.magic) + 8 + len(header)) // self.align) * self.align
+        with open(path, 'wb') as f:
+            f.write(self.magic + struct.pack('<Q', len(header)) + header)
+            for (o, n), c in zip(layout, chunks):
+                f.seek(start + o)
+                f.write(c)
+
+    def load(self, path, columns=None):
+        with open(path, 'rb') as f:
+            f.seek(len(self.magic))
+            header_len, = struct.unpack('<Q', f.read(8))
+            layout = json.loads(f.read(header_len))
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        start = -(-(len(self.magic) + 8 + header_len) // self.align) * self.align
+        mv = memoryview(mm)
+        chunks = [mv[start + o:start + o + n] for o, n in layout]
+        obj = pickle.loads(chunks[0], buffers=chunks[1:])
+        return obj if columns is None else obj[columns]
+
+class CompressedSerializer:
+    """Any object, pickled with protocol 5 and compressed by a streaming codec."""
+    codecs = ['zstd', 'lz4', 'gzip']
+
+    def __init__(self, codec='zstd', level=None):
+        if codec not in self.codecs:
+            raise ValueError(f'Unknown compression codec "{codec}".')
+        self.codec = codec
+        self.level = level
+        self.name = f'pickle-{codec}'
+        self.magic = f'RSPKLZ:{codec}\n'.encode()
+
+    def match(self, obj):
+        return True
+
+    def _open(self, f, mode):
+        if self.codec == 'zstd':
+            import zstandard
+            if mode == 'wb':
+                level = 3 if self.level is None else self.level
+                return zstandard.ZstdCompressor(level=level).stream_writer(f, closefd=False)
+            return zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+        if self.codec == 'lz4':
+            import lz4.frame
+            level = 0 if self.level is None else self.level
+            return lz4.frame.open(f, mode, compression_level=level)
+        import gzip
+        level = 1 if self.level is None else self.level
+        return gzip.GzipFile(fileobj=f, mode=mode, compresslevel=level)
+
+    def dump(self, obj, path):
+        with open(path, 'wb') as f:
+            f.write(self.magic)
+            with self._open(f, 'wb') as z:
+                pickle.dump(obj, z, protocol=5)
+
+    def load(self, path, columns=None):
+        with open(path, 'rb') as f:
+            f.seek(len(self.magic))
+            with self._open(f, 'rb') as z:
+                obj = pickle.load(z)
+        return obj if columns is None else obj[columns]
+
+register_serializer(OutOfBandSerializer())
+register_serializer(CompressedSerializer('zstd'))
+register_serializer(CompressedSerializer('lz4'))
+register_serializer(CompressedSerializer('gzip'))
+
+def test_simplecache_array_serializers():
+    import tempfile
+    import importlib.util
+    import numpy as np
+    import pandas as pd
+
+    value = {'a': np.arange(1_000_000), 'df': pd.DataFrame({'x': np.zeros(1000), 'y': np.arange(1000)}), 's': 'abc'}
+    with tempfile.TemporaryDirectory() as d:
+        names = ['pickle-oob', 'pickle-gzip']
+        names += [f'pickle-{m}' for m in ['zstd', 'lz4'] if importlib.util.find_spec(m.replace('zstd', 'zstandard'))]
+        for name in names:
+            @simplecache(f'{d}/{name}', serializer=name)
+            def test():
+                return value
+            test()
+            res = test()
+            assert (res['a'] == value['a']).all() and res['s'] == 'abc'
+            pd.testing.assert_frame_equal(res['df'], value['df'])
+            assert _detect_serializer(test.cache_path()).name == name
+
+        res = serializers['pickle-oob'].load(f'{d}/pickle-oob')
+        # array memory is not owned, but provided by memory map
+        assert not res['a'].flags.owndata
+        res['a'][0] = 100
+        assert serializers['pickle-oob'].load(f'{d}/pickle-oob')['a'][0] == 0
+        # highly compressible array
+        assert pathlib.Path(f'{d}/pickle-gzip').stat().st_size < pathlib.Path(f'{d}/pickle-oob').stat().st_size / 2
+
+
+_MISSING = object()
+
+def _sizeof(obj, _seen=None):
+    """Return approximate memory usage of `obj` in bytes."""
+    _seen = set() if _seen is None else _seen
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    np = sys.modules.get('numpy')
+    pd = sys.modules.get('pandas')
+    if pd is not None and isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if pd is not None and isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep=True))
+    if np is not None and isinstance(obj, np.ndarray):
+        size = sys.getsizeof(obj) if obj.base is None else obj.nbytes
+        if obj.dtype.hasobject:
+            size += sum(_sizeof(x, _seen) for x in obj.flat)
+        return size
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k, _seen) + _sizeof(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_sizeof(x, _seen) for x in obj)
+    elif hasattr(obj, '__dict__'):
+        size += _sizeof(vars(obj), _seen)
+    return size
+
+def _memory_return(obj, policy):
+    """Return cached `obj` according to memory policy."""
+    if policy == 'share':
+        return obj
+    np = sys.modules.get('numpy')
+    pd = sys.modules.get('pandas')
+    if policy == 'copy':
+        return copy.deepcopy(obj)
+    # readonly
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, range, frozenset)):
+        return obj
+    if np is not None and isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        v = obj.view()
+        v.flags.writeable = False
+        return v
+    if pd is not None and isinstance(obj, (pd.DataFrame, pd.Series, pd.Index)):
+        return obj.copy(deep=True)
+    if type(obj) is dict:
+        return types.MappingProxyType({k: _memory_return(v, policy) for k, v in obj.items()})
+    if type(obj) in (list, tuple):
+        return tuple(_memory_return(x, policy) for x in obj)
+    if type(obj) is set:
+        return frozenset(obj)
+    return copy.deepcopy(obj)
+
+class MemoryCache:
+    """In-process LRU cache of loaded values, bounded by total memory usage in bytes."""
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'MemoryCache({len(self._items)} items, {self.nbytes:,d} of {self.max_bytes:,d} bytes)'
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def get(self, path):
+        """Return value for cache file `path`, or `_MISSING` if not in memory or file has changed."""
+        key = str(path)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return _MISSING
+            value, nbytes, stamp = item
+            if stamp != self._stamp(path):
+                self._remove(key)
+                return _MISSING
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, path, value):
+        """Store `value` loaded from or written to cache file `path`, evicting least recently used values."""
+        key = str(path)
+        nbytes = _sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            if nbytes > self.max_bytes:
+                return
+            while self.nbytes + nbytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+            self._items[key] = (value, nbytes, self._stamp(path))
+            self.nbytes += nbytes
+
+    def discard(self, path):
+        with self._lock:
+            self._remove(str(path))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[1]
+
+memory_cache = MemoryCache()
+
+def test_simplecache_memory():
+    import tempfile
+    import numpy as np
+    import pandas as pd
+
+    with tempfile.TemporaryDirectory() as d:
+        mem = MemoryCache(max_bytes=3 * 8000 + 500)
+        calls = []
+        @simplecache(d + '/{}', memory=mem)
+        def test(x):
+            calls.append(x)
+            return np.full(1000, x, dtype='float64')
+
+        a = test(1)
+        assert test(1) is a
+        assert len(mem) == 1 and calls == [1]
+        test(2)
+        test(3)
+        test(4)
+        # LRU: value 1 was evicted, but is read back from disk
+        assert len(mem) == 3 and mem.nbytes <= mem.max_bytes
+        assert mem.get(pathlib.Path(d, '1')) is _MISSING
+        assert (test(1) == 1).all() and calls == [1, 2, 3, 4]
+        # deleted file is not served from memory
+        pathlib.Path(d, '4').unlink()
+        test(4)
+        assert calls == [1, 2, 3, 4, 4]
+
+        @simplecache(d + '/ro', memory=mem, memory_policy='readonly')
+        def test_ro():
+            return np.zeros(10)
+        test_ro()
+        x = test_ro()
+        try:
+            x[0] = 1
+            assert False, 'read-only array was modified'
+        except ValueError:
+            pass
+
+        @simplecache(d + '/copy', memory=mem, memory_policy='copy')
+        def test_copy():
+            return {'a': [1]}
+        test_copy()['a'].append(2)
+        assert test_copy() == {'a': [1]}
+
+        @simplecache(d + '/ro_dict', memory=mem, memory_policy='readonly')
+        def test_ro_dict():
+            return {'a': [1], 'b': {2}, 'c': pd.Series([1, 2])}
+        test_ro_dict()
+        x = test_ro_dict()
+        for modify in [lambda: x['a'].append(2), lambda: x['b'].add(3), lambda: x.update(d=1)]:
+            try:
+                modify()
+                assert False, 'read-only container was modified'
+            except (AttributeError, TypeError):
+                pass
+        x['c'].iloc[0] = 10
+        assert test_ro_dict()['c'].iloc[0] == 1
+
+
+def _pid_alive(pid):
+    try:
+        import psutil
+        return psutil.pid_exists(pid)
+    except ImportError:
+        pass
+    if os.name != 'posix':
+        # can not check, rely on lock age
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class FileLock:
+    """Advisory inter-process lock, held by existence of a lock file.
+    Lock of a dead process on the same host, or one not refreshed for `stale` seconds, is broken.
+    """
+    def __init__(self, path, timeout=None, stale=60, poll=0.05):
+        self.path = pathlib.Path(path)
+        self.timeout = timeout
+        self.stale = stale
+        self.poll = poll
+        self._heartbeat = None
+        self._owner = None
+        self._released = threading.Event()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def acquire(self):
+        t0 = time.monotonic()
+        delay = self.poll
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._break_stale():
+                    continue
+                if self.timeout is not None and time.monotonic() - t0 > self.timeout:
+                    raise TimeoutError(f'Could not acquire lock "{self.path}" in {self.timeout} seconds.')
+                time.sleep(delay)
+                delay = min(2 * delay, 1)
+                continue
+            self._owner = {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(), 'id': uuid.uuid4().hex}
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._owner, f)
+            self._released.clear()
+            self._heartbeat = threading.Thread(target=self._touch, daemon=True)
+            self._heartbeat.start()
+            return
+
+    def release(self):
+        """Release the lock. Does nothing if lock is not held, or if it was broken and taken by another process."""
+        owner, self._owner = self._owner, None
+        if owner is None:
+            return
+        self._released.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        state = self._read(self.path)
+        if state is not None and state[0] == owner:
+            self.path.unlink(missing_ok=True)
+
+    def _touch(self):
+        while not self._released.wait(self.stale / 4):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                # lock was broken by another process
+                return
+
+    def _read(self, path):
+        """Return (owner info, mtime) of lock file, or None if it does not exist."""
+        try:
+            mtime = path.stat().st_mtime
+            text = path.read_text()
+        except FileNotFoundError:
+            return None
+        try:
+            info = json.loads(text)
+        except ValueError:
+            # owner has not finished writing
+            info = {}
+        return info, mtime
+
+    def _break_stale(self):
+        """Remove stale lock file. Return True if lock file was removed or disappeared."""
+        state = self._read(self.path)
+        if state is None:
+            return True
+        info, mtime = state
+        dead = info.get('host') == socket.gethostname() and not _pid_alive(info['pid'])
+        if not dead and time.time() - mtime < self.stale:
+            return False
+        # rename first, so that only one of competing processes breaks the lock
+        tmp = self.path.with_name(f'{self.path.name}.{uuid.uuid4().hex}.stale')
+        try:
+            os.rename(self.path, tmp)
+        except FileNotFoundError:
+            return True
+        if self._read(tmp)[0] != info:
+            # lock was broken and taken by someone else after we looked, put it back
+            try:
+                os.link(tmp, self.path)
+            except FileExistsError:
+                pass
+        else:
+            warnings.warn(f'Removed stale cache lock "{self.path}" held by {info}.')
+        tmp.unlink(missing_ok=True)
+        return True
+
+def _lock_path(path):
+    return path.with_name(path.name + '.lock')
+
+def _atomic_dump(obj, path, serializer):
+    """Write `obj` to temporary file, then rename to `path`. Return serializer that was used."""
+    tmp = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        used = _dump(obj, tmp, serializer)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return used
+
+def _test_concurrent_worker(d, log):
+    @simplecache(d + '/x')
+    def test():
+        with open(log, 'a') as f:
+            f.write('computed\n')
+        time.sleep(1)
+        return 1
+    assert test() == 1
+
+def test_simplecache_concurrent():
+    import tempfile
+    import multiprocessing
+
+    with tempfile.TemporaryDirectory() as d:
+        log = d + '/log'
+        # fork makes test work from notebook, where worker function can not be imported
+        ctx = multiprocessing.get_context('fork' if os.name == 'posix' else 'spawn')
+        procs = [ctx.Process(target=_test_concurrent_worker, args=(d, log)) for _ in range(4)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            assert p.exitcode == 0
+        assert open(log).read() == 'computed\n'
+        assert not list(pathlib.Path(d).glob('*.lock')) and not list(pathlib.Path(d).glob('.*.tmp'))
+
+        # lock held by a live process times out
+        lock_path = pathlib.Path(d, 'y.lock')
+        with FileLock(lock_path):
+            try:
+                FileLock(lock_path, timeout=0.2).acquire()
+                assert False, 'lock acquired twice'
+            except TimeoutError:
+                pass
+
+        # lock of a dead process is broken
+        p = ctx.Process(target=time.sleep, args=(0,))
+        p.start()
+        p.join()
+        lock_path.write_text(json.dumps({'host': socket.gethostname(), 'pid': p.pid, 'time': 0}))
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            with FileLock(lock_path, timeout=1):
+                pass
+
+        # lock not refreshed for too long is broken
+        lock_path.write_text(json.dumps({'host': 'other', 'pid': 1, 'time': 0}))
+        os.utime(lock_path, (0, 0))
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            with FileLock(lock_path, timeout=1):
+                pass
+        assert not lock_path.exists()
+
+        # repeated release does not remove lock of another owner
+        lock = FileLock(lock_path)
+        lock.acquire()
+        lock.release()
+        with FileLock(lock_path):
+            lock.release()
+            assert lock_path.exists()
+
+        # lock is released once when result can not be written
+        @simplecache(d + '/unpicklable')
+        def unpicklable():
+            return lambda: None
+        try:
+            unpicklable()
+            assert False, 'unpicklable result was written'
+        except Exception:
+            pass
+        assert not list(pathlib.Path(d).glob('*.lock'))
+
+
+class CacheManager:
+    """Index of cache entries under `root` directory, with usage statistics and disk budget."""
+    index_name = '.simplecache.sqlite'
+    policies = {
+        'lru': 'accessed',
+        'cost': 'compute_time / max(size, 1), accessed',
+    }
+    memory_flush_interval = 1
+
+    def __init__(self, root, max_bytes=None, policy='lru'):
+        if policy not in self.policies:
+            raise ValueError(f'Unknown eviction policy "{policy}".')
+        self.root = pathlib.Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.stats = collections.defaultdict(collections.Counter)
+        self._memory_hits = {}
+        self._memory_flushed = time.time()
+        self._memory_lock = threading.Lock()
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS entries ('
+                        'path TEXT PRIMARY KEY, func TEXT, size INTEGER, created REAL, accessed REAL, '
+                        'compute_time REAL, hits INTEGER)')
+
+    def __repr__(self):
+        return f'CacheManager("{self.root}", max_bytes={self.max_bytes}, policy="{self.policy}")'
+
+    def _connect(self):
+        import sqlite3
+        return contextlib.closing(sqlite3.connect(self.root / self.index_name, timeout=60, isolation_level=None))
+
+    def _key(self, path):
+        path = pathlib.Path(path).absolute()
+        try:
+            return str(path.relative_to(self.root))
+        except ValueError:
+            return str(path)
+
+    def _path(self, key):
+        return self.root / key
+
+    def cache(self, path='', **kwargs):
+        """Decorator like `simplecache()`, with `path` relative to manager root."""
+        path = str(self.root / path) if isinstance(path, str) else self.root / path
+        return simplecache(path, manager=self, **kwargs)
+
+    def record_hit(self, func, path, read_time):
+        size = path.stat().st_size
+        c = self.stats[func]
+        c['hits'] += 1
+        c['bytes_read'] += size
+        c['read_time'] += read_time
+        with self._connect() as con:
+            con.execute('UPDATE entries SET accessed = ?, hits = hits + 1 WHERE path = ?',
+                        (time.time(), self._key(path)))
+
+    def record_memory_hit(self, func, path):
+        now = time.time()
+        with self._memory_lock:
+            self.stats[func]['memory_hits'] += 1
+            key = self._key(path)
+            n, _ = self._memory_hits.get(key, (0, None))
+            self._memory_hits[key] = (n + 1, now)
+            flush = now - self._memory_flushed >= self.memory_flush_interval
+        if flush:
+            self._flush_memory_hits()
+
+    def _flush_memory_hits(self):
+        """Write collected memory hits to the index."""
+        with self._memory_lock:
+            hits, self._memory_hits = self._memory_hits, {}
+            self._memory_flushed = time.time()
+        if hits:
+            with self._connect() as con:
+                con.executemany('UPDATE entries SET accessed = max(accessed, ?), hits = hits + ? WHERE path = ?',
+                                [(t, n, k) for k, (n, t) in hits.items()])
+
+    def record_miss(self, func, path, compute_time, write_time):
+        size = path.stat().st_size
+        c = self.stats[func]
+        c['misses'] += 1
+        c['bytes_written'] += size
+        c['compute_time'] += compute_time
+        c['write_time'] += write_time
+        now = time.time()
+        with self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, 0)',
+                        (self._key(path), func, size, now, now, compute_time))
+        if self.max_bytes is not None:
+            self.evict(keep=[path])
+
+    def size(self):
+        """Total size of indexed entries in bytes."""
+        with self._connect() as con:
+            return con.execute('SELECT coalesce(sum(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self, max_bytes=None, keep=()):
+        """Remove entries by eviction policy until total size is under `max_bytes`.
+        Return list of removed paths.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        keep = {self._key(p) for p in keep}
+        self._flush_memory_hits()
+        removed = []
+        with self._connect() as con:
+            total = con.execute('SELECT coalesce(sum(size), 0) FROM entries').fetchone()[0]
+            if total <= max_bytes:
+                return removed
+            order = self.policies[self.policy]
+            rows = con.execute(f'SELECT path, size FROM entries ORDER BY {order}').fetchall()
+            for key, size in rows:
+                if total <= max_bytes:
+                    break
+                if key in keep:
+                    continue
+                path = self._path(key)
+                path.unlink(missing_ok=True)
+                con.execute('DELETE FROM entries WHERE path = ?', (key,))
+                total -= size
+                removed.append(path)
+                log.info(f'Evicted cache entry "{path}" ({size:,d} bytes).')
+        return removed
+
+    def sync(self):
+        """Remove index records of entries whose files no longer exist."""
+        with self._connect() as con:
+            keys = [k for k, in con.execute('SELECT path FROM entries')]
+            for k in keys:
+                if not self._path(k).exists():
+                    con.execute('DELETE FROM entries WHERE path = ?', (k,))
+
+    def entries(self):
+        """Return dataframe with index of cache entries."""
+        import pandas as pd
+        self._flush_memory_hits()
+        with self._connect() as con:
+            df = pd.read_sql('SELECT * FROM entries', con)
+        for c in ['created', 'accessed']:
+            df[c] = pd.to_datetime(df[c], unit='s')
+        return df.set_index('path')
+
+    def report(self):
+        """Return dataframe summarizing cache entries and session statistics by function."""
+        import pandas as pd
+        self._flush_memory_hits()
+        with self._connect() as con:
+            df = pd.read_sql('SELECT func, count(*) AS entries, sum(size) AS bytes, sum(hits) AS hits, '
+                             'sum(compute_time) AS compute_time, sum(hits * compute_time) AS saved_time '
+                             'FROM entries GROUP BY func', con).set_index('func')
+        session = pd.DataFrame.from_dict({f: dict(c) for f, c in self.stats.items()}, orient='index')
+        session = session.add_prefix('session_')
+        return df.join(session, how='outer').fillna(0)
+
+def test_cache_manager():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as d:
+        mgr = CacheManager(d, max_bytes=25_000, policy='lru')
+
+        @mgr.cache('sq/{}')
+        def sq(x):
+            return b'x' * 10_000
+
+        sq(1)
+        sq(2)
+        sq(1)
+        c = mgr.stats['test_cache_manager.<locals>.sq']
+        assert c['misses'] == 2 and c['hits'] == 1
+        assert c['bytes_read'] > 10_000 and c['bytes_written'] > 20_000
+        # third entry exceeds budget, least recently used entry 2 is evicted
+        sq(3)
+        assert mgr.size() <= 25_000
+        assert sorted(p.name for p in (mgr.root / 'sq').iterdir()) == ['1', '3']
+        e = mgr.entries()
+        assert e.loc['sq/1', 'hits'] == 1
+
+        r = mgr.report()
+        assert r.loc['test_cache_manager.<locals>.sq', 'entries'] == 2
+        assert r.loc['test_cache_manager.<locals>.sq', 'session_misses'] == 3
+
+        # cost-aware policy keeps expensive entries
+        mgr = CacheManager(d + '/cost', max_bytes=25_000, policy='cost')
+        @mgr.cache('{}')
+        def slow(x):
+            time.sleep(x)
+            return b'x' * 10_000
+        slow(0.1)
+        slow(0)
+        slow(0.01)
+        assert sorted(p.name for p in mgr.root.iterdir() if not p.name.startswith('.')) == ['0.01', '0.1']
+
+        # hits from memory keep entry recently used
+        mgr = CacheManager(d + '/memory', max_bytes=25_000, policy='lru')
+        calls = []
+        @mgr.cache('{}', memory=MemoryCache())
+        def mem(x):
+            calls.append(x)
+            return b'x' * 10_000
+        mem(1)
+        mem(2)
+        for _ in range(5):
+            mem(1)
+        mem(3)
+        mem(1)
+        assert calls == [1, 2, 3]
+        assert mgr.entries().loc['1', 'hits'] == 6
+
+
+PipelineStep = collections.namedtuple('PipelineStep', ['name', 'func', 'deps', 'cache_kwargs'])
+
+class Pipeline:
+    """Cached steps with declared upstream dependencies.
+    `cache_kwargs` are passed to `simplecache()` of every step.
+    """
+    def __init__(self, root, **cache_kwargs):
+        self.root = pathlib.Path(root)
+        self.cache_kwargs = cache_kwargs
+        self.steps = {}
+        self._func_hashes = {}
+
+    def __repr__(self):
+        return f'Pipeline("{self.root}", steps={list(self.steps)})'
+
+    def __getstate__(self):
+        # memory cache is local to a process and can not be pickled
+        state = self.__dict__.copy()
+        state['cache_kwargs'] = {k: v for k, v in self.cache_kwargs.items() if k != 'memory'}
+        state['steps'] = {n: s._replace(cache_kwargs={k: v for k, v in s.cache_kwargs.items() if k != 'memory'})
+                          for n, s in self.steps.items()}
+        return state
+
+    def step(self, deps=(), name=None, **cache_kwargs):
+        """Decorator that registers function as a pipeline step. Function is returned unchanged."""
+        def wrapper(func):
+            n = func.__name__ if name is None else name
+            dep_names = [d if isinstance(d, str) else d.__name__ for d in deps]
+            for d in dep_names:
+                if d not in self.steps:
+                    raise KeyError(f'Upstream step "{d}" of "{n}" is not registered.')
+            self.steps[n] = PipelineStep(n, func, dep_names, {**self.cache_kwargs, **cache_kwargs})
+            self._func_hashes.pop(n, None)
+            return func
+        return wrapper
+
+    def key(self, name):
+        """Return hash of step function and keys of its upstream steps."""
+        step = self.steps[name]
+        if name not in self._func_hashes:
+            self._func_hashes[name] = _func_hash(step.func)
+        h = hashlib.blake2b(self._func_hashes[name].encode(), digest_size=16)
+        for d in step.deps:
+            h.update(self.key(d).encode())
+        return h.hexdigest()
+
+    def path(self, name):
+        return self.root / name / f'{name}-{self.key(name)}'
+
+    def upstream(self, name):
+        """Return set of all steps that `name` depends on."""
+        res = set()
+        for d in self.steps[name].deps:
+            res |= {d} | self.upstream(d)
+        return res
+
+    def downstream(self, name):
+        """Return set of all steps that depend on `name`."""
+        return {n for n in self.steps if name in self.upstream(n)}
+
+    def status(self):
+        """Return dict with "cached" or "missing" status of every step."""
+        return {n: 'cached' if self.path(n).exists() else 'missing' for n in self.steps}
+
+    def get(self, name):
+        """Return value of a step, computing it and its upstream steps if necessary."""
+        step = self.steps[name]
+        def compute():
+            return step.func(*(self.get(d) for d in step.deps))
+        compute.__name__ = compute.__qualname__ = name
+        return simplecache(self.path(name), **step.cache_kwargs)(compute)()
+
+    def invalidate(self, name):
+        """Remove cached values of step `name` and all its downstream steps. Return list of removed paths."""
+        removed = []
+        for n in {name} | self.downstream(name):
+            p = self.path(n)
+            if p.exists():
+                p.unlink()
+                removed.append(p)
+        return removed
+
+    def run(self, targets=None, workers=None):
+        """Compute missing values of `targets` (all steps by default) and their upstream steps.
+        With `workers` > 1, independent steps are computed in parallel processes.
+        Return list of computed step names.
+        """
+        import concurrent.futures
+        targets = list(self.steps) if targets is None else [targets] if isinstance(targets, str) else targets
+        needed = set(targets).union(*(self.upstream(t) for t in targets))
+        # steps in registration order are already sorted topologically
+        todo = [n for n in self.steps if n in needed and not self.path(n).exists()]
+        waiting = {n: {d for d in self.steps[n].deps if d in todo} for n in todo}
+        if workers is None or workers <= 1:
+            for n in todo:
+                self.get(n)
+            return todo
+        done = []
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            futures = {}
+            def submit_ready():
+                for n in [n for n, w in waiting.items() if not w]:
+                    del waiting[n]
+                    futures[pool.submit(_run_pipeline_step, self, n)] = n
+            submit_ready()
+            while futures:
+                finished, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in finished:
+                    n = futures.pop(f)
+                    f.result()
+                    done.append(n)
+                    for w in waiting.values():
+                        w.discard(n)
+                submit_ready()
+        return done
+
+def _run_pipeline_step(pipeline, name):
+    pipeline.get(name)
+
+def _test_step_a():
+    return 1
+
+def _test_step_b(a):
+    return a + 1
+
+def _test_step_c(a):
+    return a * 10
+
+def _test_step_d(b, c):
+    return b + c
+
+def test_pipeline():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as d:
+        pipe = Pipeline(d)
+        pipe.step(name='a')(_test_step_a)
+        pipe.step(['a'], name='b')(_test_step_b)
+        pipe.step(['a'], name='c')(_test_step_c)
+        pipe.step(['b', 'c'], name='d')(_test_step_d)
+        assert pipe.downstream('b') == {'d'}
+        assert sorted(pipe.run(workers=2)) == ['a', 'b', 'c', 'd']
+        assert set(pipe.status().values()) == {'cached'}
+        assert pipe.get('d') == 12
+        assert pipe.run() == []
+
+        # changed step and its downstream are recomputed
+        @pipe.step(['a'])
+        def b(a):
+            return a + 2
+        assert pipe.status() == {'a': 'cached', 'b': 'missing', 'c': 'cached', 'd': 'missing'}
+        assert pipe.run() == ['b', 'd']
+        assert pipe.get('d') == 13
+
+        pipe.invalidate('c')
+        assert pipe.run('d') == ['c', 'd']
+
+
+def _grid_calls(grid):
+    """Return list of (call, args, kwargs) from grid specification."""
+    if isinstance(grid, dict):
+        keys = list(grid)
+        grid = [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+    calls = []
+    for call in grid:
+        if isinstance(call, dict):
+            calls.append((call, (), call))
+        elif isinstance(call, tuple):
+            calls.append((call, call, {}))
+        else:
+            calls.append((call, (call,), {}))
+    return calls
+
+def _map_worker(func, args, kwargs, lazy):
+    res = func(*args, **kwargs)
+    return None if lazy else res
+
+def _cache_map(func, grid, workers=None, processes=False, lazy=False, errors='raise', progress=True):
+    """Evaluate cached `func` over `grid` of arguments, computing missing values in parallel.
+    Generator of (call, value) pairs in order of completion.
+    `progress` is True to print progress, False to only log it, or a callback `progress(done, total, call, error)`.
+    """
+    import concurrent.futures
+    if errors not in ('raise', 'warn', 'return'):
+        raise ValueError(f'Unknown errors mode "{errors}".')
+
+    def report(msg):
+        log.info(msg)
+        if progress is True:
+            print(msg, flush=True)
+
+    calls = _grid_calls(grid)
+    missing, cached = [], []
+    for c in calls:
+        (cached if func.cache_path(*c[1], **c[2]).exists() else missing).append(c)
+    name = func.__name__
+    report(f'{name}.map(): {len(cached)} of {len(calls)} values cached, computing {len(missing)}.')
+    pool_cls = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    with pool_cls(workers) as pool:
+        t0 = time.perf_counter()
+        futures = {pool.submit(_map_worker, func, args, kwargs, lazy): (call, args, kwargs)
+                   for call, args, kwargs in missing}
+        for call, args, kwargs in cached:
+            yield call, func.entry(*args, **kwargs) if lazy else func(*args, **kwargs)
+        failed = 0
+        try:
+            for i, f in enumerate(concurrent.futures.as_completed(futures), 1):
+                call, args, kwargs = futures[f]
+                dt = time.perf_counter() - t0
+                try:
+                    res = f.result()
+                except Exception as e:
+                    failed += 1
+                    report(f'{name}.map(): [{i}/{len(missing)}] {call} failed after {dt:.1f} seconds: {e!r}')
+                    if callable(progress):
+                        progress(i, len(missing), call, e)
+                    if errors == 'raise':
+                        raise
+                    if errors == 'warn':
+                        warnings.warn(f'{name}({call}) failed: {e!r}')
+                        continue
+                    yield call, e
+                    continue
+                report(f'{name}.map(): [{i}/{len(missing)}] {call} done after {dt:.1f} seconds.')
+                if callable(progress):
+                    progress(i, len(missing), call, None)
+                yield call, func.entry(*args, **kwargs) if lazy else res
+        finally:
+            for f in futures:
+                f.cancel()
+        report(f'{name}.map(): computed {len(missing) - failed} values, {failed} failed, '
+                 f'in {time.perf_counter() - t0:.1f} seconds.')
+
+def test_simplecache_map():
+    import io
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as d:
+        calls = []
+        @simplecache(d + '/{year}_{state}')
+        def test(year, state):
+            calls.append((year, state))
+            if state == 'XX':
+                raise ValueError('bad state')
+            time.sleep(0.1)
+            return f'{state}{year}'
+
+        test(2000, 'WI')
+        test(2001, 'WI')
+        grid = {'year': range(2000, 2005), 'state': ['WI', 'MN']}
+        done = []
+        res = dict((tuple(c.values()), v) for c, v in test.map(grid, workers=8, progress=lambda *x: done.append(x)))
+        assert len(res) == 10 and res[(2003, 'MN')] == 'MN2003'
+        assert len(calls) == 10
+        assert sorted(x[0] for x in done) == list(range(1, 9)) and all(x[1] == 8 and x[3] is None for x in done)
+
+        # nothing to compute
+        res = list(test.map([{'year': 2000, 'state': 'WI'}, (2001, 'WI')], lazy=True))
+        assert len(calls) == 10
+        assert res[1][1].load() == 'WI2001'
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            res = list(test.map([(2000, 'XX'), (2010, 'WI')], errors='return'))
+        assert "(2000, 'XX') failed" in out.getvalue()
+        assert dict(res)[(2010, 'WI')] == 'WI2010'
+        assert isinstance(dict(res)[(2000, 'XX')], ValueError)
+        try:
+            list(test.map([(2000, 'XX')]))
+            assert False, 'error was not raised'
+        except ValueError:
+            pass
+
+
+_pending_writes = {}
+_pending_lock = threading.Lock()
+_writer = None
+
+def _submit_write(path, value, write):
+    """Run `write()` in background thread, keeping `value` available until finished."""
+    global _writer
+    key = str(path)
+    def run():
+        try:
+            write()
+        except Exception as e:
+            log.exception(f'Background cache write to "{path}" failed.')
+            warnings.warn(f'Background cache write to "{path}" failed: {e!r}')
+        finally:
+            with _pending_lock:
+                _pending_writes.pop(key, None)
+    with _pending_lock:
+        if _writer is None:
+            import concurrent.futures
+            _writer = concurrent.futures.ThreadPoolExecutor(4, thread_name_prefix='simplecache-writer')
+        _pending_writes[key] = (value, _writer.submit(run))
+
+def _pending_value(path):
+    item = _pending_writes.get(str(path))
+    return _MISSING if item is None else item[0]
+
+def flush(timeout=None):
+    """Wait until all background cache writes are finished."""
+    with _pending_lock:
+        futures = [f for _, f in _pending_writes.values()]
+    if futures:
+        import concurrent.futures
+        concurrent.futures.wait(futures, timeout)
+
+atexit.register(flush)
+
+def test_simplecache_background():
+    import tempfile
+    import numpy as np
+
+    with tempfile.TemporaryDirectory() as d:
+        calls = []
+        @simplecache(d + '/{}', background=True, serializer='pickle-gzip')
+        def test(x):
+            calls.append(x)
+            return np.full(10_000_000, x)
+
+        a = test(1)
+        assert test(1) is a or pathlib.Path(d, '1').exists()
+        flush()
+        assert pathlib.Path(d, '1').exists()
+        assert not list(pathlib.Path(d).glob('*.lock'))
+        assert (test(1) == 1).all() and calls == [1]
+
+def test_simplecache_async():
+    import asyncio
+    import tempfile
+    import concurrent.futures
+
+    async def main(d):
+        calls = []
+        @simplecache(d + '/{}')
+        async def test(x):
+            calls.append(x)
+            await asyncio.sleep(0.2)
+            return 2 * x
+        assert await asyncio.gather(test(1), test(1), test(2)) == [2, 2, 4]
+        assert sorted(calls) == [1, 2]
+        assert await test(1) == 2
+        assert sorted(calls) == [1, 2]
+
+    with tempfile.TemporaryDirectory() as d:
+        # run in a thread, because notebook already has a running event loop
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            pool.submit(asyncio.run, main(d)).result()
+
+
 def test_all():
     test_simplecache()
+    test_simplecache_hash()
+    test_simplecache_serializers()
+    test_simplecache_array_serializers()
+    test_simplecache_memory()
+    test_simplecache_concurrent()
+    test_cache_manager()
+    test_pipeline()
+    test_simplecache_map()
+    test_simplecache_background()
+    test_simplecache_async()
 
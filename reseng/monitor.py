@@ -6,73 +6,217 @@ import os
 import io
 import time
 import json
+import struct
 import subprocess
-import inspect
+import tempfile
 import warnings
 import functools
+import threading
+import contextlib
+import contextvars
+import tracemalloc
+from pathlib import Path
 
 import psutil
 from psutil._common import bytes2human
 
 
-def usage_log(pid, interval=1):
-    """Regularly write resource usage to stdout."""
+def usage_log(pid, interval=1, tree=False, full_memory=False, emit=None, stop_event=None):
+    """Regularly write resource usage to stdout.
+    With `tree`, also sample all descendant processes of `pid`, writing one line per process.
+    `full_memory` adds USS and PSS (Linux only) memory, which is slower to measure.
+    If `emit` is given, it is called with a tuple of values instead of printing, until `stop_event` is set.
+    Sampler process itself is not sampled, and values that are not accessible due to permissions are recorded as 0.
+    """
     # local imports make function self-sufficient
-    import time, psutil
+    import os, time, psutil
 
-    p = psutil.Process(pid)
+    # sampler process is a child of monitored process with "process" backend
+    sampler_pid = os.getpid()
 
-    def get_io():
+    root = psutil.Process(pid)
+    procs = {pid: root}
+    io_before = {}
+
+    def get_io(p):
         if psutil.MACOS:
             # io_counters() not available on MacOS
             return (0, 0, 0, 0)
-        elif psutil.WINDOWS:
+        try:
             x = p.io_counters()
+        except psutil.AccessDenied:
+            # e.g. setuid process
+            return (0, 0, 0, 0)
+        if psutil.WINDOWS:
             return (x.read_bytes, 0, x.write_bytes, 0)
-        else:
-            x = p.io_counters()
-            return (x.read_bytes, x.read_chars, x.write_bytes, x.write_chars)
+        return (x.read_bytes, x.read_chars, x.write_bytes, x.write_chars)
+
+    def get_mem(p):
+        if not full_memory:
+            return (p.memory_info().rss,)
+        try:
+            x = p.memory_full_info()
+        except psutil.AccessDenied:
+            # e.g. process of another user
+            return (p.memory_info().rss, 0, 0)
+        return (x.rss, x.uss, getattr(x, 'pss', 0))
 
-    print('time,cpu,memory,read_bytes,read_chars,write_bytes,write_chars')
-    p.cpu_percent()
-    io_before = get_io()
+    def root_alive():
+        try:
+            return root.is_running() and root.status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            return False
+
+    def refresh():
+        try:
+            children = root.children(recursive=True) if tree else []
+        except psutil.NoSuchProcess:
+            children = []
+        children = [c for c in children if c.pid != sampler_pid]
+        for c in children:
+            if c.pid not in procs:
+                procs[c.pid] = c
+                c.cpu_percent()
+        alive = {pid} | {c.pid for c in children}
+        for gone in set(procs) - alive:
+            del procs[gone]
+            io_before.pop(gone, None)
+
+    header = ['time'] + (['pid'] if tree else []) + ['cpu', 'memory'] + (['uss', 'pss'] if full_memory else [])
+    header += ['read_bytes', 'read_chars', 'write_bytes', 'write_chars']
+    if emit is None:
+        print(','.join(header), flush=True)
+    root.cpu_percent()
+    io_before[pid] = get_io(root)
+    t0 = time.time()
     while True:
-        io_after = get_io()
-        io_rate = tuple((x1 - x0) / interval for x0, x1 in zip(io_before, io_after))
-        io_before = io_after
-        line = (time.time(), p.cpu_percent(), p.memory_info().rss) + io_rate
-        print(','.join(str(x) for x in line), flush=True)
-        time.sleep(interval)        
+        if stop_event is None:
+            time.sleep(interval)
+        elif stop_event.wait(interval):
+            return
+        # stop when monitored process is gone, even if its children are still running
+        if not root_alive():
+            return
+        refresh()
+        t1 = time.time()
+        dt = t1 - t0
+        t0 = t1
+        for p_pid, p in list(procs.items()):
+            try:
+                with p.oneshot():
+                    cpu = p.cpu_percent()
+                    mem = get_mem(p)
+                    io = get_io(p)
+            except psutil.NoSuchProcess:
+                if p_pid == pid:
+                    return
+                procs.pop(p_pid, None)
+                continue
+            except psutil.AccessDenied:
+                # skip process in this sample
+                continue
+            io_rate = tuple((x1 - x0) / dt for x0, x1 in zip(io_before.get(p_pid, io), io))
+            io_before[p_pid] = io
+            line = (t1,) + ((p_pid,) if tree else ()) + (cpu,) + mem + io_rate
+            if emit is None:
+                print(','.join(str(x) for x in line), flush=True)
+            else:
+                emit(line)
     
 class ResourceMonitor:
-    def __init__(self, pid=None, interval=1):
+    # monitors that are currently running, used to tag spans
+    _running = []
+
+    def __init__(self, pid=None, interval=1, backend='process', log_dir=None, log_max_bytes=2**26, log_max_files=None,
+                 tree=False, full_memory=False):
+        if backend not in ('process', 'thread'):
+            raise ValueError(f'Unknown monitor backend "{backend}".')
         self.pid = os.getpid() if pid is None else pid
         self.interval = interval
+        self.backend = backend
+        self.tree = tree
+        self.full_memory = full_memory
+        self.log_dir = log_dir
+        self.log_max_bytes = log_max_bytes
+        self.log_max_files = log_max_files
+        self.log = None
         self.tags = []
         self.df = None
+        self.df_procs = None
         if psutil.MACOS:
             warnings.warn('Disk I/O stats are not available on MacOS.')
 
     def start(self):
-        code = inspect.getsource(usage_log) + f'\nusage_log({self.pid}, {self.interval})'
+        ResourceMonitor._running.append(self)
+        columns = _usage_columns(self.tree, self.full_memory)
+        self.log = UsageLog(self.log_dir, columns, max_file_bytes=self.log_max_bytes, max_files=self.log_max_files)
+        for t, label in self.tags:
+            self.log.tag(t, label)
+        if self.backend == 'thread':
+            self._stop_event = threading.Event()
+            if self.pid == os.getpid() and not self.tree and not self.full_memory:
+                target = _sample_self
+                args = (self.interval, self.log, self._stop_event)
+            else:
+                target = usage_log
+                args = (self.pid, self.interval, self.tree, self.full_memory, self.log.append, self._stop_event)
+            self._thread = threading.Thread(target=target, args=args, daemon=True, name='ResourceMonitor')
+            self._thread.start()
+            return
+        import inspect
+        code = (inspect.getsource(usage_log)
+                + f'\nusage_log({self.pid}, {self.interval}, {self.tree}, {self.full_memory})')
         self.process = subprocess.Popen([sys.executable, '-c', code], text=True,
                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._thread = threading.Thread(target=_drain_usage_log, daemon=True, name='ResourceMonitor',
+                                        args=(self.process.stdout, self.log))
+        self._thread.start()
 
     def stop(self):
-        self.process.terminate()
-        import pandas as pd
-        log_data = self.process.stdout.read()
-        if log_data.count('\n') < 2:
+        if self in ResourceMonitor._running:
+            ResourceMonitor._running.remove(self)
+        if self.backend == 'thread':
+            self._stop_event.set()
+        else:
+            self.process.terminate()
+            self.process.wait()
+        self._thread.join()
+        self.log.close()
+        self.df = self.snapshot()
+        if self.df is None:
             warnings.warn('ResourceMonitor: no entries in monitor log, execution time may be too short.')
-            return            
-        df = pd.read_csv(io.StringIO(log_data))
-        df['elapsed'] = df['time'] - df.loc[0, 'time']
-        self.df = df.set_index('elapsed')
+        elif 'pid' in self.log.columns:
+            self.df_procs = self.snapshot(per_process=True)
+
+    def snapshot(self, per_process=False):
+        """Return dataframe with usage log collected so far, or None if log is empty.
+        In tree mode, usage is summed over processes, unless `per_process` is True.
+        """
+        return _usage_df(self.log.rows(), self.log.columns, per_process)
+
+    @classmethod
+    def recover(cls, log_dir):
+        """Create monitor from log directory of a running or crashed monitor session."""
+        m = cls()
+        m.log = UsageLog(log_dir)
+        segs = m.log.segments()
+        if segs:
+            with open(segs[0], 'rb') as f:
+                m.log.columns = json.loads(f.readline())['columns']
+        m.tags = m.log.tags()
+        m.df = m.snapshot()
+        if m.df is not None and 'pid' in m.log.columns:
+            m.df_procs = m.snapshot(per_process=True)
+        return m
 
-    def tag(self, label):
-        self.tags.append((time.time(), label))
+    def tag(self, label, t=None):
+        t = time.time() if t is None else t
+        self.tags.append((t, label))
+        if self.log is not None:
+            self.log.tag(t, label)
 
-    def plot(self):
+    def plot(self, per_process=False, max_points=2000):
+        """Plot usage log. Long series are decimated to at most `max_points` points, keeping peaks."""
         if self.df is None:
             print('ResourceMonitor: no entries in monitor log, execution time may be too short.')
             return
@@ -86,47 +230,134 @@ class ResourceMonitor:
         
         fig, axes = plt.subplots(2, 2, figsize=(12, 8))
 
+        if per_process:
+            if self.df_procs is None:
+                raise ValueError('Per-process usage is only collected with tree=True.')
+            for pid, d in self.df_procs.groupby('pid'):
+                label = f'pid {int(pid)}'
+                _plot_series(axes[0][0], d['cpu'], max_points, label=label)
+                _plot_series(axes[1][0], d['memory'], max_points, label=label)
+                _plot_series(axes[0][1], d['read_bytes'], max_points, label=label)
+                _plot_series(axes[1][1], d['write_bytes'], max_points, label=label)
+            for ax, title in zip(axes.flatten(), ['cpu', 'read bytes', 'memory', 'write bytes']):
+                ax.set_title(title)
+                ax.legend()
+                if title != 'cpu':
+                    ax.set_yticklabels([bytes2human(x) for x in ax.get_yticks()])
+            self._plot_tags(axes)
+            return
+
         ax = axes[0][0]
-        ax.plot(self.df['cpu'])
+        _plot_series(ax, self.df['cpu'], max_points)
         ax.set_title('cpu')
 
         ax = axes[1][0]
-        ax.plot(self.df['memory'])
+        _plot_series(ax, self.df['memory'], max_points)
         ax.set_title('memory')
         ax.set_yticklabels([bytes2human(x) for x in ax.get_yticks()])
 
         ax = axes[0][1]
-        ax.plot(self.df['read_bytes'], label='bytes')
-        ax.plot(self.df['read_chars'], label='chars')
+        _plot_series(ax, self.df['read_bytes'], max_points, label='bytes')
+        _plot_series(ax, self.df['read_chars'], max_points, label='chars')
         ax.set_title('read')
         ax.legend()
         ax.set_yticklabels([bytes2human(x) for x in ax.get_yticks()])
 
         ax = axes[1][1]
-        ax.plot(self.df['write_bytes'], label='bytes')
-        ax.plot(self.df['write_chars'], label='chars')
+        _plot_series(ax, self.df['write_bytes'], max_points, label='bytes')
+        _plot_series(ax, self.df['write_chars'], max_points, label='chars')
         ax.set_title('write')
         ax.legend()
         ax.set_yticklabels([bytes2human(x) for x in ax.get_yticks()])
 
+        self._plot_tags(axes)
+
+    @contextlib.contextmanager
+    def phase(self, label):
+        """Context manager that marks code block as a phase with paired "label v" and "label ^" tags."""
+        self.tag(f'{label} v')
+        try:
+            yield self
+        finally:
+            self.tag(f'{label} ^')
+
+    def phases(self):
+        """Return dataframe with usage statistics of every phase, see `_phase_table()`."""
+        return _phase_table(self.df, self.tags)
+
+    @classmethod
+    def compare_phases(cls, monitors, labels=None, metric=None):
+        """Return table of phases of several runs. `monitors` are monitor objects or paths to their dumps.
+        With `metric` (column of `phases()`), table has a row for every phase and a column for every run.
+        """
+        import pandas as pd
+        monitors = [m if isinstance(m, ResourceMonitor) else cls.load(m) for m in monitors]
+        if labels is None:
+            labels = [f'run {i}' for i in range(len(monitors))]
+        df = pd.concat({l: m.phases() for l, m in zip(labels, monitors)}, names=['run', 'phase'])
+        if metric is None:
+            return df
+        return df[metric].unstack('run').reindex(columns=labels)
+
+    def summary(self):
+        """Return dict with duration, peak memory, mean and peak CPU, and total I/O bytes of the log."""
+        return _usage_summary(self.df)
+
+    def _plot_tags(self, axes):
         t0 = self.df.loc[0, 'time']
         for ax in axes.flatten():
             y = min(l.get_data()[1].min() for l in ax.lines)
             for tag in self.tags:
                 ax.text(tag[0] - t0, y, tag[1], rotation='vertical')
 
+    @classmethod
+    def compare(cls, monitors, labels=None, max_points=2000):
+        """Plot usage of several runs on common axes, aligned by elapsed time.
+        `monitors` are `ResourceMonitor` objects or paths to their dumps.
+        """
+        import matplotlib.pyplot as plt
+        warnings.filterwarnings('ignore', message='FixedFormatter should only be used together with FixedLocator')
+        monitors = [m if isinstance(m, ResourceMonitor) else cls.load(m) for m in monitors]
+        if labels is None:
+            labels = [f'run {i}' for i in range(len(monitors))]
+        fig, axes = plt.subplots(2, 2, figsize=(12, 8))
+        for m, label in zip(monitors, labels):
+            if m.df is None:
+                continue
+            for ax, col in zip(axes.flatten(), ['cpu', 'read_bytes', 'memory', 'write_bytes']):
+                _plot_series(ax, m.df[col], max_points, label=label)
+        for ax, title in zip(axes.flatten(), ['cpu', 'read bytes', 'memory', 'write bytes']):
+            ax.set_title(title)
+            ax.legend()
+            if title != 'cpu':
+                ax.set_yticklabels([bytes2human(x) for x in ax.get_yticks()])
+
     def dump(self, filepath):
+        """Save tags and usage log to file.
+        Files with ".npz" extension are saved in binary format, other files as JSON.
+        """
+        if str(filepath).endswith('.npz'):
+            _dump_npz(self, filepath)
+            return
         d = {'tags': self.tags,
              'data': self.df.to_csv()}
+        if self.df_procs is not None:
+            d['procs'] = self.df_procs.to_csv()
         json.dump(d, open(filepath, 'w'))
 
     @classmethod
     def load(cls, filepath):
         import pandas as pd
+        with open(filepath, 'rb') as f:
+            binary = f.read(4) == b'PK\x03\x04'
+        if binary:
+            return _load_npz(cls(), filepath)
         d = json.load(open(filepath))
         m = cls()
         m.tags = d['tags']
         m.df = pd.read_csv(io.StringIO(d['data'])).set_index('elapsed')
+        if 'procs' in d:
+            m.df_procs = pd.read_csv(io.StringIO(d['procs'])).set_index('elapsed')
         return m
 
     
@@ -206,15 +437,463 @@ def test_resource_monitor_serialization():
         m2.plot()
 
 
+def _dump_npz(mon, filepath):
+    import numpy as np
+    arrays = {'tags/time': np.array([t for t, _ in mon.tags], dtype='float64'),
+              'tags/label': np.array([l for _, l in mon.tags], dtype=str)}
+    for name, df in [('data', mon.df), ('procs', mon.df_procs)]:
+        if df is None:
+            continue
+        df = df.reset_index()
+        for c in df:
+            arrays[f'{name}/{c}'] = df[c].to_numpy()
+    with open(filepath, 'wb') as f:
+        np.savez(f, **arrays)
+
+def _load_npz(mon, filepath):
+    import numpy as np
+    import pandas as pd
+    with np.load(filepath) as z:
+        mon.tags = list(zip(z['tags/time'].tolist(), z['tags/label'].tolist()))
+        for name in ['data', 'procs']:
+            cols = {k.split('/', 1)[1]: z[k] for k in z.files if k.startswith(name + '/')}
+            df = pd.DataFrame(cols).set_index('elapsed') if cols else None
+            setattr(mon, 'df' if name == 'data' else 'df_procs', df)
+    return mon
+
+def _decimate(y, max_points):
+    """Return indices of at most `max_points` samples of `y` that keep minimum and maximum of every bucket."""
+    import numpy as np
+    n = len(y)
+    if n <= max_points:
+        return np.arange(n)
+    y = np.asarray(y, dtype='float64')
+    size = -(-n // (max_points // 2))
+    nb = -(-n // size)
+    # pad last bucket with its last value, does not change extremes
+    pad = np.empty(nb * size)
+    pad[:n] = y
+    pad[n:] = y[-1]
+    nan = np.isnan(pad)
+    lo = np.where(nan, np.inf, pad).reshape(nb, size).argmin(axis=1)
+    hi = np.where(nan, -np.inf, pad).reshape(nb, size).argmax(axis=1)
+    starts = np.arange(nb) * size
+    idx = np.sort(np.stack([lo, hi], axis=1), axis=1) + starts[:, None]
+    return np.minimum(idx.ravel(), n - 1)
+
+def _plot_series(ax, s, max_points, **kwargs):
+    idx = _decimate(s, max_points)
+    ax.plot(s.index.to_numpy()[idx], s.to_numpy()[idx], **kwargs)
+
+def test_resource_monitor_long_log():
+    import numpy as np
+    import pandas as pd
+    from tempfile import TemporaryDirectory
+
+    n = 2_000_000
+    t = np.arange(n) * 0.1
+    rng = np.random.default_rng(0)
+    m1 = ResourceMonitor()
+    m1.df = pd.DataFrame({'elapsed': t, 'time': t + 1e9, 'cpu': rng.random(n) * 100, 'memory': np.full(n, 2**30),
+                          'read_bytes': 0.0, 'read_chars': 0.0, 'write_bytes': 0.0, 'write_chars': 0.0}).set_index('elapsed')
+    m1.df.iloc[12345, m1.df.columns.get_loc('memory')] = 2**32
+    m1.tags = [(1e9 + 10, 'a v'), (1e9 + 20, 'a ^')]
+
+    idx = _decimate(m1.df['memory'], 1000)
+    assert len(idx) <= 1000 and (np.diff(idx) >= 0).all()
+    assert 12345 in idx
+
+    with TemporaryDirectory() as d:
+        t0 = time.time()
+        m1.dump(f'{d}/m.npz')
+        m2 = ResourceMonitor.load(f'{d}/m.npz')
+        print(f'npz dump and load of {n} samples: {time.time() - t0:.2f} seconds')
+        assert m2.tags == m1.tags
+        pd.testing.assert_frame_equal(m1.df, m2.df)
+        assert m2.df_procs is None
+
+        t0 = time.time()
+        m2.plot()
+        ResourceMonitor.compare([m1, f'{d}/m.npz'], labels=['a', 'b'])
+        print(f'plot and compare: {time.time() - t0:.2f} seconds')
+
+
+def _phase_bounds(tags, t_end):
+    """Return list of (label, start, end) of phases from paired " v" and " ^" tags.
+    Phases that were not closed end at `t_end`.
+    """
+    opened, count, res = {}, {}, []
+    for t, label in sorted(tags, key=lambda x: x[0]):
+        name = label[:-2]
+        if label.endswith(' v'):
+            count[name] = count.get(name, 0) + 1
+            opened.setdefault(name, []).append(len(res))
+            res.append([name if count[name] == 1 else f'{name} #{count[name]}', t, t_end])
+        elif label.endswith(' ^') and opened.get(name):
+            res[opened[name].pop()][2] = t
+    return res
+
+def _phase_table(df, tags):
+    """Return dataframe indexed by phase label with duration and usage statistics of phases in usage log."""
+    import pandas as pd
+    columns = ['start', 'duration', 'samples', 'peak_memory', 'mean_memory', 'mean_cpu', 'peak_cpu',
+               'read_bytes', 'write_bytes', 'read_throughput', 'write_throughput']
+    if df is None or len(df) == 0:
+        return pd.DataFrame(columns=columns).rename_axis('phase')
+    t = df['time'].to_numpy()
+    dt = _sample_intervals(df)
+    rows = {}
+    for label, t0, t1 in _phase_bounds(tags, t[-1]):
+        # sample at time t covers interval since previous sample
+        i0, i1 = t.searchsorted(t0, 'right'), t.searchsorted(t1, 'right')
+        if i0 == i1 and i1 < len(t):
+            i1 += 1
+        s = _usage_summary(df.iloc[i0:i1], dt.iloc[i0:i1])
+        row = {'start': t0 - t[0], 'duration': t1 - t0, 'samples': s['samples']}
+        if s['samples']:
+            for c in columns[3:9]:
+                row[c] = s[c]
+            io_time = max(t1 - t0, s['duration'])
+            row['read_throughput'] = s['read_bytes'] / io_time
+            row['write_throughput'] = s['write_bytes'] / io_time
+        rows[label] = row
+    return pd.DataFrame.from_dict(rows, orient='index', columns=columns).rename_axis('phase')
+
+def test_resource_monitor_phases():
+    from tempfile import TemporaryDirectory, TemporaryFile
+
+    runs = []
+    for size in [20, 60]:
+        mon = ResourceMonitor(interval=0.05, backend='thread')
+        mon.start()
+        with mon.phase('cpu'):
+            _use_cpu(0.5)
+        with mon.phase('mem'):
+            x = [1] * size * 1_000_000
+            time.sleep(0.3)
+            del x
+        with TemporaryFile() as tf:
+            with mon.phase('io'):
+                with mon.phase('write'):
+                    _write(tf, 100)
+                with mon.phase('write'):
+                    _write(tf, 100)
+        time.sleep(0.2)
+        mon.stop()
+        runs.append(mon)
+
+    ph = runs[0].phases()
+    print(ph)
+    assert list(ph.index) == ['cpu', 'mem', 'io', 'write', 'write #2']
+    assert ph.loc['cpu', 'mean_cpu'] > 50
+    assert ph.loc['cpu', 'duration'] >= 0.5
+    assert ph.loc['mem', 'peak_memory'] > ph.loc['cpu', 'peak_memory'] + 100 * 2**20
+    assert ph.loc['io', 'start'] <= ph.loc['write', 'start'] < ph.loc['write #2', 'start']
+    # second write overwrites the same pages of the file, so it may not be counted again
+    assert ph.loc['io', 'write_bytes'] > 90 * 2**20
+
+    with TemporaryDirectory() as d:
+        runs[1].dump(f'{d}/run.npz')
+        cmp = ResourceMonitor.compare_phases([runs[0], f'{d}/run.npz'], labels=['small', 'large'], metric='peak_memory')
+        print(cmp)
+        assert list(cmp.columns) == ['small', 'large']
+        assert cmp.loc['mem', 'large'] > cmp.loc['mem', 'small']
+    assert len(ResourceMonitor.compare_phases(runs)) == 10
+
+
+_log_columns = ['time', 'cpu', 'memory', 'read_bytes', 'read_chars', 'write_bytes', 'write_chars']
+
+def _usage_columns(tree=False, full_memory=False):
+    """Return list of columns written by `usage_log()` with given options."""
+    return (['time'] + (['pid'] if tree else []) + ['cpu', 'memory'] + (['uss', 'pss'] if full_memory else [])
+            + ['read_bytes', 'read_chars', 'write_bytes', 'write_chars'])
+
+def _self_usage_reader():
+    """Return functions to read usage counters of current process and to release resources.
+    Reader returns tuple of (cpu_time, rss, read_bytes, read_chars, write_bytes, write_chars).
+    """
+    if sys.platform.startswith('linux'):
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        statm = os.open('/proc/self/statm', os.O_RDONLY)
+        try:
+            io_fd = os.open('/proc/self/io', os.O_RDONLY)
+            os.pread(io_fd, 512, 0)
+        except OSError:
+            # not accessible in some containers
+            io_fd = None
+        def read():
+            rss = int(os.pread(statm, 128, 0).split()[1]) * page_size
+            if io_fd is None:
+                return (time.process_time(), rss, 0, 0, 0, 0)
+            c = dict(line.split(b': ') for line in os.pread(io_fd, 512, 0).splitlines())
+            return (time.process_time(), rss,
+                    int(c[b'read_bytes']), int(c[b'rchar']), int(c[b'write_bytes']), int(c[b'wchar']))
+        def close():
+            os.close(statm)
+            if io_fd is not None:
+                os.close(io_fd)
+        return read, close
+
+    p = psutil.Process()
+    def read():
+        rss = p.memory_info().rss
+        if psutil.MACOS:
+            return (time.process_time(), rss, 0, 0, 0, 0)
+        x = p.io_counters()
+        if psutil.WINDOWS:
+            return (time.process_time(), rss, x.read_bytes, 0, x.write_bytes, 0)
+        return (time.process_time(), rss, x.read_bytes, x.read_chars, x.write_bytes, x.write_chars)
+    return read, lambda: None
+
+def _sample_self(interval, log, stop_event):
+    """Append usage rows of current process to `log` every `interval` seconds until `stop_event` is set."""
+    read, close = _self_usage_reader()
+    try:
+        start = t0 = time.time()
+        c0 = read()
+        k = 0
+        while True:
+            k += 1
+            # schedule by absolute time to avoid drift
+            if stop_event.wait(max(0, start + k * interval - time.time())):
+                break
+            t1 = time.time()
+            c1 = read()
+            dt = max(t1 - t0, 1e-9)
+            log.append((t1, 100 * (c1[0] - c0[0]) / dt, c1[1])
+                        + tuple((x1 - x0) / dt for x0, x1 in zip(c0[2:], c1[2:])))
+            t0, c0 = t1, c1
+    finally:
+        close()
+
+def test_resource_monitor_thread():
+    from tempfile import TemporaryFile
+
+    mon = ResourceMonitor(interval=0.01, backend='thread')
+    mon.start()
+    time.sleep(0.2)
+    mon.tag('cpu v')
+    _use_cpu(0.5)
+    mon.tag('cpu ^')
+    with TemporaryFile() as tf:
+        _write(tf, 50)
+    mon.stop()
+    assert len(mon.df) > 50
+    assert list(mon.df.columns) == _log_columns
+    assert mon.df['cpu'].max() > 50
+    if sys.platform.startswith('linux'):
+        assert mon.df['write_chars'].max() > 0
+    mon.plot()
+
+
+class UsageLog:
+    """Collector of usage samples, kept in memory or streamed to a rotating binary log in directory `path`."""
+    def __init__(self, path=None, columns=_log_columns, max_file_bytes=2**26, max_files=None):
+        self.path = None if path is None else Path(path)
+        self.columns = list(columns)
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self._fmt = struct.Struct(f'<{len(self.columns)}d')
+        self._rows = []
+        self._tags = []
+        self._file = None
+        self._lock = threading.Lock()
+        if self.path is not None:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self):
+        return f'UsageLog({"memory" if self.path is None else self.path})'
+
+    def segments(self):
+        return sorted(self.path.glob('usage-*.bin'))
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        segs = self.segments()
+        n = int(segs[-1].stem.split('-')[1]) + 1 if segs else 1
+        self._file = open(self.path / f'usage-{n:06d}.bin', 'wb')
+        self._file.write(json.dumps({'columns': self.columns}).encode() + b'\n')
+        if self.max_files is not None:
+            for old in segs[:max(0, len(segs) + 1 - self.max_files)]:
+                old.unlink()
+
+    def append(self, row):
+        with self._lock:
+            if self.path is None:
+                self._rows.append(tuple(row))
+                return
+            if self._file is None or self._file.tell() >= self.max_file_bytes:
+                self._rotate()
+            self._file.write(self._fmt.pack(*row))
+            self._file.flush()
+
+    def tag(self, t, label):
+        with self._lock:
+            self._tags.append((t, label))
+            if self.path is not None:
+                with open(self.path / 'tags.jsonl', 'a') as f:
+                    f.write(json.dumps([t, label]) + '\n')
+
+    def tags(self):
+        if self.path is None or not (self.path / 'tags.jsonl').exists():
+            return list(self._tags)
+        with open(self.path / 'tags.jsonl') as f:
+            return [tuple(json.loads(line)) for line in f if line.endswith('\n')]
+
+    def rows(self):
+        """Return 2D array of all samples in the log."""
+        import numpy as np
+        if self.path is None:
+            with self._lock:
+                rows = list(self._rows)
+            return np.array(rows, dtype='float64').reshape(-1, len(self.columns))
+        parts = []
+        for seg in self.segments():
+            try:
+                with open(seg, 'rb') as f:
+                    header = json.loads(f.readline())
+                    data = f.read()
+            except FileNotFoundError:
+                # deleted by rotation
+                continue
+            ncol = len(header['columns'])
+            # last record may be incomplete if writer crashed
+            n = len(data) // (8 * ncol)
+            parts.append(np.frombuffer(data[:8 * ncol * n], '<f8').reshape(n, ncol))
+        if not parts:
+            return np.empty((0, len(self.columns)))
+        return np.concatenate(parts)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def _usage_df(rows, columns, per_process=False):
+    """Return usage log dataframe indexed by elapsed time, or None if there are no rows.
+    Per-process rows are summed by time, unless `per_process` is True.
+    """
+    import pandas as pd
+    if len(rows) < 1:
+        return None
+    df = pd.DataFrame(rows, columns=columns)
+    if 'pid' in df and not per_process:
+        g = df.groupby('time', sort=True)
+        df = g.sum().drop(columns='pid')
+        df.insert(0, 'processes', g.size())
+        df = df.reset_index()
+    df['elapsed'] = df['time'] - df['time'].iloc[0]
+    return df.set_index('elapsed')
+
+def _drain_usage_log(stream, log):
+    """Read CSV lines from monitor process output into `log` until end of stream."""
+    header = stream.readline().strip().split(',')
+    if header != log.columns:
+        warnings.warn(f'ResourceMonitor: unexpected monitor output: {",".join(header)}')
+    for line in stream:
+        try:
+            log.append([float(x) for x in line.split(',')])
+        except ValueError:
+            warnings.warn(f'ResourceMonitor: unexpected monitor output: {line.strip()}')
+
+def test_resource_monitor_streaming():
+    from tempfile import TemporaryDirectory
+
+    with TemporaryDirectory() as d:
+        mon = ResourceMonitor(interval=0.01, backend='thread', log_dir=d, log_max_bytes=1000)
+        mon.start()
+        time.sleep(0.2)
+        mon.tag('cpu v')
+        _use_cpu(0.2)
+        mon.tag('cpu ^')
+        # monitor is still running, as if the program has crashed
+        snap = mon.snapshot()
+        assert len(snap) > 10
+        m2 = ResourceMonitor.recover(d)
+        assert len(m2.df) >= len(snap)
+        assert [t[1] for t in m2.tags] == ['cpu v', 'cpu ^']
+        mon.stop()
+        assert len(mon.log.segments()) > 1
+        assert len(mon.df) >= len(m2.df)
+
+    with TemporaryDirectory() as d:
+        mon = ResourceMonitor(interval=0.1, log_dir=d, log_max_bytes=500, log_max_files=2)
+        mon.start()
+        time.sleep(3)
+        assert len(mon.snapshot()) > 5
+        mon.stop()
+        assert len(mon.log.segments()) <= 2
+        assert 0 < len(mon.df) < 30
+
+
+def test_resource_monitor_tree():
+    code = 'import time\nt = time.time()\nwhile time.time() - t < 1: pass'
+    for backend in ['process', 'thread']:
+        mon = ResourceMonitor(interval=0.1, backend=backend, tree=True, full_memory=True)
+        mon.start()
+        time.sleep(0.5)
+        mon.tag('children v')
+        children = [subprocess.Popen([sys.executable, '-c', code]) for _ in range(2)]
+        for c in children:
+            c.wait()
+        mon.tag('children ^')
+        time.sleep(0.5)
+        mon.stop()
+        pids = set(mon.df_procs['pid'].astype(int))
+        assert {c.pid for c in children} <= pids
+        # this process and two children, sampler process is not included
+        assert mon.df['processes'].max() == 3
+        if backend == 'process':
+            assert mon.process.pid not in pids
+        assert mon.df['cpu'].max() > 50
+        assert (mon.df['uss'] > 0).all()
+    mon.plot(per_process=True)
+
+    # sampler stops when monitored process exits
+    p = subprocess.Popen([sys.executable, '-c', 'import os, time\ntime.sleep(0.3)\nos._exit(1)'])
+    mon = ResourceMonitor(p.pid, interval=0.1, tree=True)
+    mon.start()
+    p.wait()
+    try:
+        mon.process.wait(2)
+    except subprocess.TimeoutExpired:
+        mon.process.kill()
+        raise AssertionError('Sampler process did not stop after monitored process exited.')
+    mon.stop()
+
+    # values that are not accessible are recorded as 0 and sampling continues
+    import psutil
+    def denied(self):
+        raise psutil.AccessDenied(self.pid)
+    original = psutil.Process.io_counters, psutil.Process.memory_full_info
+    psutil.Process.io_counters = psutil.Process.memory_full_info = denied
+    try:
+        mon = ResourceMonitor(interval=0.1, backend='thread', tree=True, full_memory=True)
+        mon.start()
+        time.sleep(0.5)
+        mon.stop()
+    finally:
+        psutil.Process.io_counters, psutil.Process.memory_full_info = original
+    assert len(mon.df) >= 3 and (mon.df['memory'] > 0).all() and (mon.df['uss'] == 0).all()
+
+
 def func_sig(f, *args, **kwargs):
     """Return string representing function with argument values."""
-    import pandas as pd
+    pd = sys.modules.get('pandas')
+    np = sys.modules.get('numpy')
     def arg2str(x):
-        if isinstance(x, pd.Series):
+        if pd is not None and isinstance(x, pd.Series):
             return f'series({len(x)})'
-        if isinstance(x, pd.DataFrame):
+        if pd is not None and isinstance(x, pd.DataFrame):
             return f'dataframe{x.shape}'
-        s = str(x)
+        if np is not None and isinstance(x, np.ndarray):
+            return f'array{x.shape}'
+        if isinstance(x, (list, tuple, dict, set, frozenset)):
+            # str() of a large container is expensive
+            return f'{type(x).__name__}({len(x)})'
+        s = x[:11] if isinstance(x, str) else str(x)
         if len(s) <= 10:
             return s
         else:
@@ -227,16 +906,30 @@ def func_sig(f, *args, **kwargs):
     a = ', '.join(a)
     return f'{f.__name__}({a})'
 
-def log_start_finish(f):
-    """Print function call signature on start and on finish with total runtime."""
+def log_start_finish(f=None, *, verbose=True):
+    """Print function call signature on start and on finish with total runtime.
+    Call is recorded as a span while `spans` is recording, inside of another span or while a `ResourceMonitor` is running.
+    Use `verbose=False` to only record.
+    """
+    if f is None:
+        return functools.partial(log_start_finish, verbose=verbose)
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
+        if not verbose and not _spans_wanted():
+            return f(*args, **kwargs)
         sig = func_sig(f, *args, **kwargs)
-        t0 = time.time()
-        print(f'{time.asctime()}: {sig} started.')
-        res = f(*args, **kwargs)
-        dt = time.time() - t0
-        print(f'{time.asctime()}: {sig} finished in {dt:.2f} seconds.')
+        if verbose:
+            print(f'{time.asctime()}: {sig} started.')
+        if _spans_wanted():
+            with span(sig, f.__qualname__) as s:
+                res = f(*args, **kwargs)
+            wall = s.wall
+        else:
+            t0 = time.perf_counter()
+            res = f(*args, **kwargs)
+            wall = time.perf_counter() - t0
+        if verbose:
+            print(f'{time.asctime()}: {sig} finished in {wall:.2f} seconds.')
         return res
     return wrapper
 
@@ -251,8 +944,326 @@ def test_log_start_finish():
     func(1, d=pd.DataFrame(index=range(1000), columns=range(5)))
 
 
+_current_span = contextvars.ContextVar('reseng_monitor_span', default=None)
+_this_process = None
+
+def _rss():
+    global _this_process
+    if _this_process is None:
+        _this_process = psutil.Process()
+    return _this_process.memory_info().rss
+
+class Span:
+    """Resource usage record of a code block."""
+    def __init__(self, name, func, parent):
+        self.name = name
+        self.func = func
+        self.parent = parent
+        self.children = []
+        self.start = time.time()
+        self.wall = None
+        self.cpu = None
+        self.rss_delta = None
+        self.peak_alloc = None
+        self._mem0 = 0
+        self._peak = 0
+
+    def __repr__(self):
+        return f'Span({self.name}, wall={self.wall})'
+
+    def summary(self):
+        peak = '' if self.peak_alloc is None else f', peak alloc {bytes2human(self.peak_alloc)}'
+        sign = '-' if self.rss_delta < 0 else '+'
+        return (f'{self.name}: {self.wall:.3f} s wall, {self.cpu:.3f} s cpu, '
+                f'rss {sign}{bytes2human(abs(self.rss_delta))}{peak}')
+
+    def walk(self, depth=0):
+        """Iterate over (depth, span) pairs of this span and all its descendants."""
+        yield depth, self
+        for c in self.children:
+            yield from c.walk(depth + 1)
+
+class SpanCollector:
+    """Storage of finished top-level spans."""
+    def __init__(self):
+        self.roots = []
+        self._recording = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'SpanCollector({len(self.roots)} top-level spans)'
+
+    @property
+    def active(self):
+        return self._recording > 0
+
+    @contextlib.contextmanager
+    def recording(self):
+        """Keep spans that finish inside of this block."""
+        with self._lock:
+            self._recording += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._recording -= 1
+
+    def add(self, span):
+        with self._lock:
+            self.roots.append(span)
+
+    def clear(self):
+        with self._lock:
+            self.roots = []
+
+    def walk(self):
+        for r in list(self.roots):
+            yield from r.walk()
+
+    def report(self):
+        """Return call tree of recorded spans as a string."""
+        return '\n'.join('  ' * d + s.summary() for d, s in self.walk())
+
+    def totals(self):
+        """Return dataframe with number of calls, totals and wall time percentiles by function."""
+        import pandas as pd
+        df = pd.DataFrame([(s.func, s.wall, s.cpu, s.rss_delta, s.peak_alloc) for _, s in self.walk()],
+                          columns=['func', 'wall', 'cpu', 'rss_delta', 'peak_alloc'])
+        g = df.groupby('func')
+        res = pd.DataFrame({
+            'calls': g.size(),
+            'wall': g['wall'].sum(),
+            'cpu': g['cpu'].sum(),
+            'wall_mean': g['wall'].mean(),
+            'wall_p50': g['wall'].quantile(0.5),
+            'wall_p90': g['wall'].quantile(0.9),
+            'wall_p99': g['wall'].quantile(0.99),
+            'wall_max': g['wall'].max(),
+            'rss_delta': g['rss_delta'].sum(),
+            'peak_alloc': g['peak_alloc'].max(),
+        })
+        return res.sort_values('wall', ascending=False)
+
+spans = SpanCollector()
+
+def _spans_wanted():
+    """Return True if a new span would be recorded or tagged."""
+    return spans.active or _current_span.get() is not None or bool(ResourceMonitor._running)
+
+@contextlib.contextmanager
+def span(name, func=None, collector=None):
+    """Record resource usage of a code block as a span, nested in currently active span.
+    Top-level span is kept in `collector`, or in `spans` if it is recording.
+    """
+    keep = collector is not None or spans.active
+    collector = spans if collector is None else collector
+    parent = _current_span.get()
+    s = Span(name, name if func is None else func, parent)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if parent is not None:
+            parent._peak = max(parent._peak, peak)
+        tracemalloc.reset_peak()
+        s._mem0 = s._peak = current
+    for mon in list(ResourceMonitor._running):
+        mon.tag(f'{name} v')
+    rss0 = _rss()
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    token = _current_span.set(s)
+    try:
+        yield s
+    finally:
+        _current_span.reset(token)
+        s.wall = time.perf_counter() - t0
+        s.cpu = time.process_time() - cpu0
+        s.rss_delta = _rss() - rss0
+        if tracing and tracemalloc.is_tracing():
+            s._peak = max(s._peak, tracemalloc.get_traced_memory()[1])
+            s.peak_alloc = s._peak - s._mem0
+            if parent is not None:
+                parent._peak = max(parent._peak, s._peak)
+        for mon in list(ResourceMonitor._running):
+            mon.tag(f'{name} ^')
+        if parent is not None:
+            parent.children.append(s)
+        elif keep:
+            collector.add(s)
+
+def test_spans():
+    @log_start_finish(verbose=False)
+    def inner(n):
+        x = [0] * n
+        time.sleep(0.01)
+        return len(x)
+
+    @log_start_finish(verbose=False)
+    def outer(xs):
+        return sum(inner(n) for n in xs)
+
+    spans.clear()
+    # nothing is kept when not recording
+    outer([10])
+    with span('block'):
+        inner(5)
+    assert spans.roots == []
+
+    tracemalloc.start()
+    mon = ResourceMonitor(interval=0.01, backend='thread')
+    mon.start()
+    try:
+        with spans.recording():
+            outer([10, 1_000_000, 10])
+            with span('block'):
+                inner(5)
+    finally:
+        mon.stop()
+        tracemalloc.stop()
+    root, block = spans.roots
+    assert root.name == 'outer(list(3))' and len(root.children) == 3
+    assert block.name == 'block' and block.children[0].name == 'inner(5)'
+    assert root.children[1].peak_alloc >= 8_000_000
+    assert root.peak_alloc >= root.children[1].peak_alloc
+    assert root.wall >= sum(c.wall for c in root.children)
+    t = spans.totals()
+    assert t.loc['test_spans.<locals>.inner', 'calls'] == 4
+    assert 'inner(1000000)' in spans.report()
+    assert [l for _, l in mon.tags] == ['outer(list(3)) v', 'inner(10) v', 'inner(10) ^', 'inner(1000000) v',
+                                        'inner(1000000) ^', 'inner(10) v', 'inner(10) ^', 'outer(list(3)) ^',
+                                        'block v', 'inner(5) v', 'inner(5) ^', 'block ^']
+
+
+def _sample_intervals(df):
+    """Return series of time intervals covered by samples of usage log dataframe."""
+    # rate in every sample covers interval since previous sample
+    dt = df['time'].diff()
+    dt.iloc[0] = dt.iloc[1:].median() if len(df) > 1 else 0
+    return dt
+
+def _usage_summary(df, dt=None):
+    """Return dict with summary statistics of usage log dataframe.
+    `dt` are sample intervals, if `df` is a slice of a longer log.
+    """
+    if df is None or len(df) == 0:
+        return {'samples': 0}
+    if dt is None:
+        dt = _sample_intervals(df)
+    res = {
+        'samples': len(df),
+        'duration': float(df['time'].iloc[-1] - df['time'].iloc[0] + dt.iloc[0]),
+        'peak_memory': int(df['memory'].max()),
+        'mean_memory': float(df['memory'].mean()),
+        'mean_cpu': float(df['cpu'].mean()),
+        'peak_cpu': float(df['cpu'].max()),
+    }
+    for c in ['read_bytes', 'read_chars', 'write_bytes', 'write_chars']:
+        res[c] = int((df[c] * dt).sum())
+    return res
+
+def _read_tags_file(f, mon):
+    """Add tags from new lines in open file `f` to monitor `mon`."""
+    for line in f.readlines():
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        t, sep, label = line.partition('\t')
+        try:
+            t = float(t) if sep else None
+        except ValueError:
+            t, label = None, line
+        mon.tag(label if sep else line, t)
+
+def run_command(cmd, interval=1, output=None, log_dir=None, full_memory=False):
+    """Run `cmd` (list of program and arguments) monitoring its process tree.
+    Save usage log to `output`, print summary to stderr and return exit code of the command.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        tags_path = Path(tmp) / 'tags'
+        tags_path.touch()
+        env = {**os.environ, 'RESENG_MONITOR_TAGS': str(tags_path)}
+        proc = subprocess.Popen(cmd, env=env)
+        mon = ResourceMonitor(proc.pid, interval, backend='thread', tree=True, full_memory=full_memory, log_dir=log_dir)
+        mon.start()
+        with open(tags_path) as tags_file:
+            while True:
+                try:
+                    rc = proc.wait(min(interval, 1))
+                    break
+                except subprocess.TimeoutExpired:
+                    _read_tags_file(tags_file, mon)
+                except KeyboardInterrupt:
+                    # interrupt is also received by the child, wait for it to exit
+                    continue
+            _read_tags_file(tags_file, mon)
+        mon.stop()
+
+    if output is not None and mon.df is not None:
+        mon.dump(output)
+    s = _usage_summary(mon.df)
+    lines = [f'reseng.monitor: command exited with code {rc}.']
+    if s['samples'] == 0:
+        lines.append('  no samples collected, execution time may be too short.')
+    else:
+        lines += [
+            f'  duration: {s["duration"]:.1f} seconds, {s["samples"]} samples',
+            f'  peak memory: {bytes2human(s["peak_memory"])}',
+            f'  cpu: mean {s["mean_cpu"]:.1f}%, peak {s["peak_cpu"]:.1f}%',
+            f'  read: {bytes2human(s["read_bytes"])}, write: {bytes2human(s["write_bytes"])}',
+        ]
+        if output is not None:
+            lines.append(f'  usage log saved to "{output}"')
+    print('\n'.join(lines), file=sys.stderr)
+    return rc
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m reseng.monitor', description='Resource usage monitor.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('run', help='run a command and monitor its process tree')
+    p.add_argument('-i', '--interval', type=float, default=1, help='sampling interval in seconds')
+    p.add_argument('-o', '--output', help='file to save usage log to, readable by ResourceMonitor.load()')
+    p.add_argument('--log-dir', help='directory to stream usage log to while running')
+    p.add_argument('--full-memory', action='store_true', help='also record USS and PSS memory')
+    p.add_argument('cmd', nargs=argparse.REMAINDER, help='command to run, after "--"')
+    args = parser.parse_args(argv)
+    cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+    if not cmd:
+        parser.error('command to run is missing')
+    return run_command(cmd, args.interval, args.output, args.log_dir, args.full_memory)
+
+def test_cli():
+    code = ('import os, time\n'
+            'tags = open(os.environ["RESENG_MONITOR_TAGS"], "a")\n'
+            'tags.write("cpu v\\n"); tags.flush()\n'
+            't = time.time()\n'
+            'while time.time() - t < 1: pass\n'
+            'tags.write(f"{time.time()}\\tcpu ^\\n"); tags.flush()\n'
+            'time.sleep(0.5)\n'
+            'raise SystemExit(3)\n')
+    with tempfile.TemporaryDirectory() as d:
+        out = str(Path(d) / 'usage.json')
+        rc = main(['run', '-i', '0.1', '-o', out, '--', sys.executable, '-c', code])
+        assert rc == 3
+        m = ResourceMonitor.load(out)
+        assert [l for _, l in m.tags] == ['cpu v', 'cpu ^']
+        assert m.df['cpu'].max() > 50
+        assert m.summary()['duration'] > 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
 def test_all():
     test_resource_monitor()
     test_resource_monitor_serialization()
+    test_resource_monitor_long_log()
+    test_resource_monitor_phases()
+    test_resource_monitor_thread()
+    test_resource_monitor_streaming()
+    test_resource_monitor_tree()
     test_log_start_finish()
+    test_spans()
+    test_cli()
 
@@ -4,19 +4,23 @@
 import sys
 import os
 import re
+import json
+import time
+import select
+import struct
+import hashlib
 from pathlib import Path
-import inspect
-
-import nbconvert
-import nbformat
+import itertools
 
 
 class Nbd:
     nbs_dir_name = 'nbs'
+    manifest_name = '.nbd-manifest.json'
+    _root_cache = {}
     
-    def __init__(self, pkg_name):
+    def __init__(self, pkg_name, root=None):
         self.pkg_name = pkg_name
-        self.root = self._locate_root_path()
+        self.root = self._locate_root_path() if root is None else self._find_root(root)
         self.pkg_path = self.root / pkg_name
         self.nbs_path = self.root / self.nbs_dir_name
         self.tmp = self.root / 'tmp' # convenience shortcut, may not exist
@@ -27,7 +31,7 @@ class Nbd:
 
     def _locate_root_path(self):
         # call stack: 0=this function, 1=__init__(), 2=caller
-        caller = inspect.stack()[2].filename
+        caller = sys._getframe(2).f_code.co_filename
         interpreters = ['<ipython-input', 'xpython_', 'ipykernel_', '<stdin>']
         if any(x in caller for x in interpreters):
             # class initialized from interactive shell or notebook
@@ -35,11 +39,19 @@ class Nbd:
         else:
             # class initialized from module
             p0 = caller
+        return self._find_root(p0)
+
+    def _find_root(self, p0):
+        """Return first directory at or above `p0` that contains notebook and package dirs."""
         p = p0 = Path(p0).resolve()
+        key = (p0, self.pkg_name, self.nbs_dir_name)
+        if key in Nbd._root_cache:
+            return Nbd._root_cache[key]
         while p != p.anchor:
             pkg_dir = p / self.pkg_name
             nbs_dir = p / self.nbs_dir_name
             if pkg_dir.exists() and nbs_dir.exists():
+                Nbd._root_cache[key] = p
                 return p
             p = p.parent
         raise Exception(f'Could not find project root above "{p0}".')
@@ -94,31 +106,229 @@ def test_relative_import():
         assert __relative_import(x, line, file) == expected
 
 
-def __nb2mod(self, nb_rel_path):
-    """Convert notebook to script, only including cells tagged with "nbd-module".
-    `nb_rel_path` is relative to project's notebook directory."""
-    nb_rel_path = Path(nb_rel_path)
+# lines that IPython would translate into Python calls: magics, shell and help escapes, prompts
+_ipython_syntax = re.compile(r'^[ \t]*([%!?,;/]|>>>|\.\.\.|In \[\d*\]:)|^[^#\n]*(=[ \t]*[%!]|\?[ \t]*$)', re.M)
+
+def _is_jupytext_md(path):
+    """Return True if Markdown file has Jupytext header."""
+    with open(path) as f:
+        head = f.read(1024)
+    return head.startswith('---') and '\njupytext:' in head
+
+def _parse_cells(text, suffix):
+    """Return list of (cell_type, source, tags) of notebook in ".ipynb" or Jupytext MyST ".md" format.
+    Only code cells are returned from Markdown notebooks.
+    Raise ValueError if a code cell in Markdown notebook is not terminated.
+    """
+    if suffix == '.ipynb':
+        res = []
+        for c in json.loads(text)['cells']:
+            src = c['source']
+            res.append((c['cell_type'], src if isinstance(src, str) else ''.join(src),
+                        c.get('metadata', {}).get('tags', [])))
+        return res
+    res = []
+    lines = text.split('\n')
+    i = 0
+    while i < len(lines):
+        m = re.match(r'(`{3,})\{code-cell\}', lines[i])
+        i += 1
+        if not m:
+            continue
+        fence = m.group(1)
+        start = i
+        tags = []
+        if i < len(lines) and lines[i] == '---':
+            # YAML metadata block
+            if '---' not in lines[i + 1:]:
+                raise ValueError(f'Unterminated code cell metadata at line {start}.')
+            j = lines.index('---', i + 1)
+            meta, i = lines[i + 1:j], j + 2
+            for k, l in enumerate(meta):
+                if l.startswith('tags:'):
+                    tags = _parse_tags(l[5:]) if l[5:].strip() else [
+                        x.strip()[1:].strip().strip('\'"') for x in itertools.takewhile(
+                            lambda x: x.strip().startswith('-'), meta[k + 1:])]
+        elif i < len(lines) and lines[i].startswith(':'):
+            while i < len(lines) and lines[i].startswith(':'):
+                if lines[i].startswith(':tags:'):
+                    tags = _parse_tags(lines[i][6:])
+                i += 1
+            i += 1
+        j = i
+        while j < len(lines) and lines[j] != fence:
+            j += 1
+        if j >= len(lines):
+            raise ValueError(f'Unterminated code cell at line {start}.')
+        res.append(('code', '\n'.join(lines[i:j]), tags))
+        i = j + 1
+    return res
+
+def _parse_tags(s):
+    """Parse YAML flow list of tags, like "[a, 'b']"."""
+    s = s.strip().strip('[]')
+    return [t.strip().strip('\'"') for t in s.split(',') if t.strip()]
+
+def _cell_script(source):
+    """Return cell source as it appears in script exported by nbconvert, or None if it has IPython syntax."""
+    if _ipython_syntax.search(source):
+        return None
+    # same cleanup as IPython's TransformerManager.transform_cell()
+    if not source.endswith('\n'):
+        source += '\n'
+    lines = source.splitlines(keepends=True)
+    for k, l in enumerate(lines):
+        if l and not l.isspace():
+            lines = lines[k:]
+            break
+    m = re.match(r'[ \t]+', lines[0])
+    if m:
+        lines = [l[m.end():] if l.startswith(m.group()) else l for l in lines]
+    # exporter template drops last newline
+    return ''.join(lines)[:-1]
+
+def __notebook_path(self, nb_rel_path):
+    """Return absolute path to notebook file, or to its paired Markdown file if ".ipynb" does not exist."""
     nb_path = self.nbs_path / nb_rel_path
+    if not nb_path.is_file() and nb_path.suffix == '.ipynb' and nb_path.with_suffix('.md').is_file():
+        nb_path = nb_path.with_suffix('.md')
     assert nb_path.is_file(), f'Notebook not found at "{nb_path}".'
-    nb = nbformat.read(nb_path, nbformat.current_nbformat)
-    nb.cells = [c for c in nb.cells 
-                if ((c.cell_type == 'code') 
-                    and ('tags' in  c.metadata)
-                    and ('nbd-module' in c.metadata.tags))]
-    exporter = nbconvert.exporters.PythonExporter(exclude_input_prompt=True)
-    script, _ = exporter.from_notebook_node(nb)
+    return nb_path
+Nbd._notebook_path = __notebook_path
+
+def __nb2script(self, nb_rel_path, use_nbconvert=False):
+    """Return script converted from notebook, only including cells tagged with "nbd-module".
+    `nb_rel_path` is relative to project's notebook directory.
+    Notebook can be in ".ipynb" or Jupytext MyST ".md" format."""
+    nb_rel_path = Path(nb_rel_path)
+    nb_path = self._notebook_path(nb_rel_path)
+    cells = [source for cell_type, source, tags in _parse_cells(nb_path.read_text(), nb_path.suffix)
+             if cell_type == 'code' and 'nbd-module' in tags]
+    parts = None if use_nbconvert else [_cell_script(c) for c in cells]
+    if parts is None or None in parts:
+        import nbconvert
+        import nbformat
+        nb = nbformat.v4.new_notebook()
+        nb.cells = [nbformat.v4.new_code_cell(c) for c in cells]
+        exporter = nbconvert.exporters.PythonExporter(exclude_input_prompt=True)
+        script, _ = exporter.from_notebook_node(nb)
+    else:
+        script = '#!/usr/bin/env python\n# coding: utf-8\n'
+        if parts:
+            script += '\n' + '\n\n\n'.join(parts) + '\n\n'
     mod_path = self.pkg_path / nb_rel_path.with_suffix('.py')
 
     # convert abs to rel imports
     script = '\n'.join(self._relative_import(l, mod_path.relative_to(self.pkg_path))
                        for l in script.split('\n'))
+    return script
+Nbd._nb2script = __nb2script
+
+_test_md = '''---
+jupytext:
+  text_representation:
+    format_name: myst
+---
+
++++ {"tags": ["nbd-docs"]}
+
+Module docs.
+
+~~~{code-cell} ipython3
+:tags: [nbd-module]
+
+from pkg.a import x
+~~~
+
+~~~{code-cell} ipython3
+---
+tags:
+- nbd-module
+- hide-input
+---
+
+def f():
+    return 1
+~~~
+
+~~~{code-cell} ipython3
+f()
+~~~
+
+~~~~{code-cell} ipython3
+:tags: [nbd-docs, nbd-module]
+
+s = """
+~~~{code-cell}
+"""
+~~~~
+'''.replace('~', '`')
 
-    mod_path.parent.mkdir(parents=True, exist_ok=True)
-    mod_path.write_text(script)
+def test_nb2script():
+    import tempfile
+    sources = ['import os\n', 'x = 1\n\n\n', '', '  \n', '\n\n', '\n\n  a = 1\n  b = 2\n c = 3',
+               '#| code-fold: false\ny = 2', 'def f():\n    """Docstring."""\n    return 1', 'a\r\nb',
+               'x = [1,\n     2]  # comment?', '"""\nmulti-line string\n    """']
+    with tempfile.TemporaryDirectory() as d:
+        nbd = _test_project(d)
+        for i, src in enumerate(sources + ['%time f()\nx = 1', 'y = ' + '!ls', 'f?']):
+            _test_notebook(nbd.nbs_path / f'nb{i}.ipynb', [('code', src, ['nbd-module']), ('code', 'z = 1', ['nbd-module'])])
+            fast, slow = nbd._nb2script(f'nb{i}.ipynb'), nbd._nb2script(f'nb{i}.ipynb', use_nbconvert=True)
+            assert fast == slow, (src, fast, slow)
+        _test_notebook(nbd.nbs_path / 'all.ipynb', [('code', src, ['nbd-module']) for src in sources]
+                       + [('markdown', 'docs', ['nbd-module']), ('code', 'f()', [])])
+        assert nbd._nb2script('all.ipynb') == nbd._nb2script('all.ipynb', use_nbconvert=True)
+        _test_notebook(nbd.nbs_path / 'empty.ipynb', [('code', 'f()', [])])
+        assert nbd._nb2script('empty.ipynb') == nbd._nb2script('empty.ipynb', use_nbconvert=True)
 
-    src = nb_path.relative_to(self.root)
+        (nbd.nbs_path / 'md.md').write_text(_test_md)
+        cells = _parse_cells(_test_md, '.md')
+        assert [c[2] for c in cells] == [['nbd-module'], ['nbd-module', 'hide-input'], [], ['nbd-docs', 'nbd-module']]
+        assert cells[3][1] == 's = """\n' + '`' * 3 + '{code-cell}\n"""'
+        script = nbd._nb2script('md.ipynb')
+        assert script == nbd._nb2script('md.md', use_nbconvert=True)
+        assert 'from .a import x\n\n\ndef f():' in script and 'f()\n' not in script
+
+        # half-saved notebooks
+        for text in [_test_md[:_test_md.rindex('`' * 3)], '`' * 3 + '{code-cell} ipython3\n:tags: [nbd-module]',
+                     '`' * 3 + '{code-cell} ipython3\n---\ntags: [nbd-module]\n']:
+            try:
+                _parse_cells(text, '.md')
+            except ValueError as e:
+                print('Truncated notebook:', e)
+            else:
+                raise AssertionError('Truncated notebook did not fail.')
+
+
+def _write_if_changed(path, text):
+    """Write `text` to file, unless file already has identical content. Return True if file was written."""
+    path = Path(path)
+    data = text.encode()
+    try:
+        if path.read_bytes() == data:
+            return False
+    except FileNotFoundError:
+        pass
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return True
+
+def __nb2mod(self, nb_rel_path, use_nbconvert=False):
+    """Convert notebook to module, only including cells tagged with "nbd-module".
+    `nb_rel_path` is relative to project's notebook directory, see `Nbd._nb2script()`.
+    Module file is not touched if its content would not change. Return True if module was written."""
+    nb_rel_path = Path(nb_rel_path)
+    script = self._nb2script(nb_rel_path, use_nbconvert)
+    mod_path = self.pkg_path / nb_rel_path.with_suffix('.py')
+    written = _write_if_changed(mod_path, script)
+
+    src = self._notebook_path(nb_rel_path).relative_to(self.root)
     dst = mod_path.relative_to(self.root)
-    print(f'Converted notebook "{src}" to module "{dst}".')
+    if written:
+        print(f'Converted notebook "{src}" to module "{dst}".')
+    else:
+        print(f'Module "{dst}" is up to date with notebook "{src}".')
+    return written
 Nbd.nb2mod = __nb2mod
 
 def test_nbd_nb2mod():
@@ -126,25 +336,597 @@ def test_nbd_nb2mod():
     nbd.nb2mod('nbd.ipynb')
 
 
-def filter_docs():
-    """Only keep cells with "nbd-docs" tag.
-    Reads notebook from STDIN and prints filtered notebook to STDOUT.
+def __notebooks(self):
+    """Return sorted list of notebook paths relative to notebook dir.
+    Jupytext Markdown notebook is only included if there is no paired ".ipynb" file.
+    """
+    res = []
+    # symlinks to package dirs are not followed
+    for dirpath, dirnames, filenames in os.walk(self.nbs_path):
+        dirnames[:] = [d for d in dirnames if not d.startswith(('.', '_'))]
+        for f in filenames:
+            p = Path(dirpath, f)
+            if f.endswith('.ipynb') or (f.endswith('.md') and p.with_suffix('.ipynb').name not in filenames
+                                        and _is_jupytext_md(p)):
+                res.append(p.relative_to(self.nbs_path))
+    return sorted(res)
+Nbd._notebooks = __notebooks
+
+def _module_cells_hash(nb_bytes, suffix):
+    """Return hash of sources of "nbd-module" code cells in notebook, or None if there are no such cells."""
+    h = hashlib.sha256()
+    n = 0
+    for cell_type, source, tags in _parse_cells(nb_bytes.decode(), suffix):
+        if cell_type == 'code' and 'nbd-module' in tags:
+            h.update(source.encode())
+            h.update(b'\0')
+            n += 1
+    return h.hexdigest() if n else None
+
+def _build_worker(pkg_name, root, nb_rel_path):
+    """Convert one notebook in a build, return tuple (True if module was written, error or None)."""
+    try:
+        nbd = Nbd(pkg_name, root)
+        script = nbd._nb2script(nb_rel_path)
+        return _write_if_changed(nbd.pkg_path / Path(nb_rel_path).with_suffix('.py'), script), None
+    except Exception as e:
+        return False, repr(e)
+
+def __build(self, workers=None, force=False):
+    """Convert notebooks with changed "nbd-module" cells to modules using `workers` processes.
+    Return dict with lists of "rebuilt", "identical", "skipped" and "failed" notebooks.
     """
-    nb = nbformat.reads(sys.stdin.read(), as_version=nbformat.NO_CONVERT)
+    t0 = time.time()
+    manifest_path = self.nbs_path / self.manifest_name
+    try:
+        manifest = json.loads(manifest_path.read_text())
+    except FileNotFoundError:
+        manifest = {}
+    new_manifest = {}
+    report = {'rebuilt': [], 'identical': [], 'skipped': [], 'failed': []}
+    todo = {}
+    for nb_rel_path in self._notebooks():
+        key = nb_rel_path.as_posix()
+        mod_exists = (self.pkg_path / nb_rel_path.with_suffix('.py')).exists()
+        old = manifest.get(key, {})
+        data = (self.nbs_path / nb_rel_path).read_bytes()
+        nb_hash = hashlib.sha256(data).hexdigest()
+        if not force and old.get('nb_hash') == nb_hash and (mod_exists or old['cells_hash'] is None):
+            new_manifest[key] = old
+            report['skipped'].append(key)
+            continue
+        try:
+            entry = {'nb_hash': nb_hash, 'cells_hash': _module_cells_hash(data, nb_rel_path.suffix)}
+        except (ValueError, KeyError) as e:
+            report['failed'].append(key)
+            print(f'Failed to read notebook "{key}": {e!r}')
+            continue
+        if entry['cells_hash'] is None or (not force and mod_exists and old.get('cells_hash') == entry['cells_hash']):
+            new_manifest[key] = entry
+            report['skipped'].append(key)
+        else:
+            todo[key] = entry
+
+    keys = list(todo)
+    if workers == 1 or len(keys) < 2:
+        results = [_build_worker(self.pkg_name, self.root, key) for key in keys]
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            n = len(keys)
+            results = list(pool.map(_build_worker, [self.pkg_name] * n, [self.root] * n, keys))
+    for key, (written, error) in zip(keys, results):
+        if error is not None:
+            report['failed'].append(key)
+            print(f'Failed to convert notebook "{key}": {error}')
+            continue
+        new_manifest[key] = todo[key]
+        report['rebuilt' if written else 'identical'].append(key)
+
+    manifest_path.write_text(json.dumps(new_manifest, indent=1, sort_keys=True))
+    counts = ', '.join(f'{len(v)} {k}' for k, v in report.items())
+    print(f'Built package "{self.pkg_name}" in {time.time() - t0:.2f} seconds: {counts}.')
+    for k in ['rebuilt', 'identical', 'failed']:
+        if report[k]:
+            print(f'  {k}: {", ".join(report[k])}')
+    return report
+Nbd.build = __build
+
+def _test_project(root, pkg_name='pkg'):
+    """Create minimal project structure in `root` directory."""
+    root = Path(root)
+    (root / pkg_name).mkdir()
+    (root / Nbd.nbs_dir_name).mkdir()
+    (root / Nbd.nbs_dir_name / pkg_name).symlink_to(f'../{pkg_name}')
+    return Nbd(pkg_name, root)
+
+def _test_notebook(path, cells):
+    """Write notebook with `cells` given as list of (cell_type, source, tags)."""
+    import nbformat
+    nb = nbformat.v4.new_notebook()
+    for cell_type, source, tags in cells:
+        new_cell = nbformat.v4.new_code_cell if cell_type == 'code' else nbformat.v4.new_markdown_cell
+        nb.cells.append(new_cell(source, metadata={'tags': tags}))
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    nbformat.write(nb, path)
+
+def test_nbd_build():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        nbd = _test_project(d)
+        _test_notebook(nbd.nbs_path / 'a.ipynb', [('markdown', 'Module a.', ['nbd-docs']),
+                                                  ('code', 'x = 1', ['nbd-module']),
+                                                  ('code', 'x', [])])
+        _test_notebook(nbd.nbs_path / 'sub/b.ipynb', [('code', 'from pkg.a import x', ['nbd-module'])])
+        _test_notebook(nbd.nbs_path / 'c.ipynb', [('code', 'print(1)', [])])
+        # paired Markdown notebook is ignored, unpaired is converted
+        (nbd.nbs_path / 'c.md').write_text(_test_md)
+        (nbd.nbs_path / 'sub/readme.md').write_text('# Not a notebook')
+        _test_notebook(nbd.nbs_path / '.ipynb_checkpoints/a-checkpoint.ipynb', [('code', 'y = 1', ['nbd-module'])])
+
+        r = nbd.build(workers=2)
+        assert r['rebuilt'] == ['a.ipynb', 'sub/b.ipynb'] and r['skipped'] == ['c.ipynb']
+        assert 'from ..a import x' in (nbd.pkg_path / 'sub/b.py').read_text()
+        assert not (nbd.pkg_path / 'c.py').exists()
+        assert nbd.build()['skipped'] == ['a.ipynb', 'c.ipynb', 'sub/b.ipynb']
+
+        # docs cell edit does not trigger conversion
+        _test_notebook(nbd.nbs_path / 'a.ipynb', [('markdown', 'Module a, edited.', ['nbd-docs']),
+                                                  ('code', 'x = 1', ['nbd-module']),
+                                                  ('code', 'x', [])])
+        assert len(nbd.build()['skipped']) == 3
+        _test_notebook(nbd.nbs_path / 'a.ipynb', [('code', 'x = 2', ['nbd-module'])])
+        assert nbd.build()['rebuilt'] == ['a.ipynb']
+        assert 'x = 2' in (nbd.pkg_path / 'a.py').read_text()
+
+        # identical output is not written
+        mtime = (nbd.pkg_path / 'a.py').stat().st_mtime_ns
+        r = nbd.build(force=True)
+        assert r['identical'] == ['a.ipynb', 'sub/b.ipynb']
+        assert (nbd.pkg_path / 'a.py').stat().st_mtime_ns == mtime
+
+        (nbd.pkg_path / 'sub/b.py').unlink()
+        assert nbd.build()['rebuilt'] == ['sub/b.ipynb']
+
+        (nbd.nbs_path / 'c.ipynb').unlink()
+        assert nbd.build()['rebuilt'] == ['c.md']
+
+        (nbd.nbs_path / 'a.ipynb').write_text('not a notebook')
+        r = nbd.build()
+        assert r['failed'] == ['a.ipynb']
+        assert 'a.ipynb' not in json.loads((nbd.nbs_path / nbd.manifest_name).read_text())
+
+
+class _Inotify:
+    """Watch directory tree for files that were written or moved in, using Linux inotify."""
+    # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    mask = 0x8 | 0x80 | 0x100
+    IN_ISDIR = 0x40000000
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+        self.dirs = {}
+        self._add_tree(root)
+
+    def _add_tree(self, root):
+        """Watch directory and its subdirectories, return list of files that are already in them."""
+        files = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(('.', '_'))]
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.mask)
+            if wd >= 0:
+                self.dirs[wd] = dirpath
+            files += [os.path.join(dirpath, f) for f in filenames]
+        return files
+
+    def read(self, timeout):
+        """Return list of changed file paths, waiting up to `timeout` seconds for first change."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        paths = []
+        while True:
+            try:
+                data = os.read(self.fd, 2**16)
+            except BlockingIOError:
+                return paths
+            i = 0
+            while i < len(data):
+                wd, mask, _, n = struct.unpack_from('iIII', data, i)
+                name = data[i + 16:i + 16 + n].rstrip(b'\0')
+                i += 16 + n
+                if wd not in self.dirs or not name:
+                    continue
+                path = os.path.join(self.dirs[wd], os.fsdecode(name))
+                if mask & self.IN_ISDIR:
+                    if not name.startswith((b'.', b'_')):
+                        paths += self._add_tree(path)
+                elif mask & (0x8 | 0x80):
+                    paths.append(path)
+
+    def close(self):
+        os.close(self.fd)
+
+class _Poller:
+    """Watch directory tree for changed notebook files by checking their modification times."""
+
+    def __init__(self, root, interval=1):
+        self.root = root
+        self.interval = interval
+        self.mtimes = self._scan()
+
+    def _scan(self):
+        res = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(('.', '_'))]
+            for f in filenames:
+                if f.endswith(('.ipynb', '.md')):
+                    p = os.path.join(dirpath, f)
+                    try:
+                        res[p] = os.stat(p).st_mtime_ns
+                    except FileNotFoundError:
+                        pass
+        return res
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        mtimes = self._scan()
+        paths = [p for p, t in mtimes.items() if self.mtimes.get(p) != t]
+        self.mtimes = mtimes
+        return paths
+
+    def close(self):
+        pass
+
+def __watch_key(self, path):
+    """Return notebook path relative to notebook dir that should be converted after `path` changed, or None."""
+    p = Path(path)
+    if p.suffix not in ('.ipynb', '.md'):
+        return None
+    rel = p.relative_to(self.nbs_path)
+    if any(x.startswith(('.', '_')) for x in rel.parts):
+        return None
+    try:
+        if p.suffix == '.md' and not _is_jupytext_md(p):
+            return None
+    except OSError:
+        return None
+    # paired notebook is converted from ".ipynb" if it exists
+    return rel.with_suffix('.ipynb')
+Nbd._watch_key = __watch_key
+
+def __watch(self, debounce=0.2, backend='auto', poll_interval=1, stop=None):
+    """Convert notebooks to modules when they are saved, until interrupted or `stop` event is set.
+    `backend` is "inotify", "poll" or "auto" to use inotify where available."""
+    if backend == 'auto':
+        backend = 'inotify' if sys.platform.startswith('linux') else 'poll'
+    if backend == 'inotify':
+        try:
+            watcher = _Inotify(self.nbs_path)
+        except (OSError, AttributeError) as e:
+            print(f'inotify is not available ({e}), falling back to polling.')
+            backend = 'poll'
+    if backend == 'poll':
+        watcher = _Poller(self.nbs_path, poll_interval)
+    print(f'Watching notebooks in "{self.nbs_path}" with {backend}, press Ctrl+C to stop.')
+    pending = {}
+    try:
+        while stop is None or not stop.is_set():
+            paths = watcher.read(debounce if pending else 0.5)
+            now = time.perf_counter()
+            for p in paths:
+                key = self._watch_key(p)
+                if key is not None:
+                    pending[key] = now
+            # wait until changes stop, but not for too long if they never stop
+            if not pending or (paths and now - min(pending.values()) < 10 * debounce):
+                continue
+            for key, t_save in pending.items():
+                t0 = time.perf_counter()
+                try:
+                    script = self._nb2script(key)
+                    mod_path = self.pkg_path / key.with_suffix('.py')
+                    status = 'rebuilt' if _write_if_changed(mod_path, script) else 'unchanged'
+                except Exception as e:
+                    status = f'failed with {e!r}'
+                t1 = time.perf_counter()
+                print(f'{time.strftime("%H:%M:%S")} "{key}" {status} in {(t1 - t0) * 1000:.0f} ms, '
+                      f'{(t1 - t_save) * 1000:.0f} ms after save.')
+            pending = {}
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+Nbd.watch = __watch
+
+def test_nbd_watch():
+    import tempfile
+    import threading
+    for backend in ['inotify', 'poll']:
+        with tempfile.TemporaryDirectory() as d:
+            nbd = _test_project(d)
+            stop = threading.Event()
+            thread = threading.Thread(target=nbd.watch, kwargs=dict(debounce=0.05, backend=backend,
+                                                                     poll_interval=0.1, stop=stop))
+            thread.start()
+            time.sleep(0.2)
+            try:
+                for i, path in enumerate(['a.ipynb', 'sub/b.ipynb', 'a.ipynb']):
+                    _test_notebook(nbd.nbs_path / path, [('code', f'x = {i}', ['nbd-module'])])
+                    mod = (nbd.pkg_path / path).with_suffix('.py')
+                    for _ in range(50):
+                        if mod.exists() and f'x = {i}' in mod.read_text():
+                            break
+                        time.sleep(0.1)
+                    else:
+                        raise AssertionError(f'Module "{mod}" was not updated by {backend} watch.')
+            finally:
+                stop.set()
+                thread.join()
+
+
+def _filter_docs_nbformat(text):
+    """Return notebook JSON text with only "nbd-docs" cells, using `nbformat`."""
+    import nbformat
+    nb = nbformat.reads(text, as_version=nbformat.NO_CONVERT)
     nb.cells = [
         c for c in nb.cells
         if ('tags' in c.metadata) and ('nbd-docs' in c.metadata.tags)
     ]
-    nbformat.write(nb, sys.stdout)
+    text = nbformat.writes(nb)
+    return text if text.endswith('\n') else text + '\n'
+
+_json_struct = re.compile(r'["\[\]{}:]')
+
+def _scan_cells(text):
+    """Return span of "cells" array and list of (cell span, metadata span) in notebook JSON text.
+    Cell contents other than metadata are scanned, but not parsed.
+    Raise ValueError if text ends inside of a string.
+    """
+    depth = 0
+    keys = [None] * 5
+    prev = None
+    cells_span, cells = None, []
+    in_cells = False
+    pos = 0
+    while True:
+        m = _json_struct.search(text, pos)
+        if m is None:
+            break
+        t, pos = m.group(), m.end()
+        if t == '"':
+            # skip string, possibly very long, to closing quote that is not escaped
+            while True:
+                end = text.find('"', pos)
+                if end == -1:
+                    raise ValueError(f'Unterminated string starting at {m.start()}.')
+                k = end
+                while text[k - 1] == '\\':
+                    k -= 1
+                pos = end + 1
+                if (end - k) % 2 == 0:
+                    break
+            prev = (m.start(), pos)
+        elif t == ':':
+            if depth < 5:
+                keys[depth] = text[prev[0]:prev[1]]
+        elif t in '[{':
+            depth += 1
+            if depth == 2 and t == '[' and keys[1] == '"cells"':
+                in_cells = True
+                cells_start = m.start()
+            elif in_cells and depth == 3:
+                cell_start, meta, keys[3] = m.start(), None, None
+            elif in_cells and depth == 4 and keys[3] == '"metadata"':
+                meta_start = m.start()
+        else:
+            if in_cells and depth == 4 and keys[3] == '"metadata"':
+                meta = (meta_start, m.end())
+            elif in_cells and depth == 3:
+                cells.append(((cell_start, m.end()), meta))
+            elif in_cells and depth == 2:
+                cells_span = (cells_start, m.end())
+                in_cells = False
+            depth -= 1
+    return cells_span, cells
+
+def _is_json_mime(mime):
+    return mime == 'application/json' or (mime.startswith('application/') and mime.endswith('+json'))
+
+def _normalize_lines(cell):
+    """Rejoin and split multi-line strings of a cell like `nbformat` does when notebook is read and written."""
+    if isinstance(cell.get('source'), list):
+        cell['source'] = ''.join(cell['source'])
+    if isinstance(cell.get('source'), str):
+        cell['source'] = cell['source'].splitlines(True)
+    bundles = list(cell.get('attachments', {}).values())
+    if cell.get('cell_type') == 'code':
+        for output in cell.get('outputs', []):
+            if output.get('output_type') in ('execute_result', 'display_data'):
+                bundles.append(output.get('data', {}))
+            elif output.get('output_type') and isinstance(output.get('text', ''), list):
+                output['text'] = ''.join(output['text'])
+            if output.get('output_type') == 'stream' and isinstance(output.get('text'), str):
+                output['text'] = output['text'].splitlines(True)
+    for data in bundles:
+        for k, v in list(data.items()):
+            if not _is_json_mime(k) and isinstance(v, list) and all(isinstance(x, str) for x in v):
+                v = data[k] = ''.join(v)
+            if isinstance(v, str) and (k.startswith('text/') or k in ('application/javascript', 'image/svg+xml')):
+                data[k] = v.splitlines(True)
+    cell.get('metadata', {}).pop('trusted', None)
+    return cell
+
+def _filter_docs_json(text):
+    """Return notebook JSON text with only "nbd-docs" cells.
+    Only metadata of dropped cells is parsed, and output is the same as with `_filter_docs_nbformat()`.
+    """
+    try:
+        cells_span, cells = _scan_cells(text)
+    except ValueError:
+        # truncated notebook, let nbformat report the error
+        cells_span = None
+    if cells_span is None:
+        return _filter_docs_nbformat(text)
+    a, b = cells_span
+    nb = json.loads(text[:a] + '[]' + text[b:])
+    if nb.get('nbformat') != 4:
+        return _filter_docs_nbformat(text)
+    for (a, b), meta in cells:
+        if meta is not None and 'nbd-docs' in json.loads(text[meta[0]:meta[1]]).get('tags', []):
+            nb['cells'].append(_normalize_lines(json.loads(text[a:b])))
+    for k in ['orig_nbformat', 'orig_nbformat_minor', 'signature']:
+        nb.get('metadata', {}).pop(k, None)
+    return json.dumps(nb, sort_keys=True, indent=1, separators=(',', ': '), ensure_ascii=False) + '\n'
+
+def filter_docs(src=None, dst=None):
+    """Only keep cells with "nbd-docs" tag.
+    Reads notebook from file `src` or STDIN and writes filtered notebook to file `dst` or STDOUT.
+    """
+    text = sys.stdin.read() if src is None else Path(src).read_text(encoding='utf-8')
+    text = _filter_docs_json(text)
+    if dst is None:
+        sys.stdout.write(text)
+    else:
+        Path(dst).parent.mkdir(parents=True, exist_ok=True)
+        Path(dst).write_text(text, encoding='utf-8')
+
+def filter_docs_batch(paths, out_dir):
+    """Filter notebooks at `paths` in one process, writing results to `out_dir`.
+    Relative paths are kept under `out_dir`. Return list of output paths.
+    Raise ValueError if an output would overwrite an input notebook or another output.
+    """
+    paths = [Path(p) for p in paths]
+    res = [Path(out_dir) / (p.name if p.is_absolute() else p) for p in paths]
+    inputs = {p.resolve() for p in paths}
+    seen = {}
+    for p, dst in zip(paths, res):
+        if dst.resolve() in inputs:
+            raise ValueError(f'Filtered "{p}" would overwrite input notebook "{dst}".')
+        if dst.resolve() in seen:
+            raise ValueError(f'Filtered "{p}" and "{seen[dst.resolve()]}" would both be written to "{dst}".')
+        seen[dst.resolve()] = p
+    for p, dst in zip(paths, res):
+        filter_docs(p, dst)
+    return res
+
+def test_filter_docs():
+    import io
+    import tempfile
+    import contextlib
+    import nbformat
+    from nbformat import v4
+    png = 'iVBORw0KGgo' * 100_000
+    def notebook(minor):
+        nb = v4.new_notebook(metadata={'kernelspec': {'name': 'python3', 'display_name': 'Python 3'}, 'orig_nbformat': 3, 'title': 'Ünïcode "quotes" \\\\'})
+        nb.nbformat_minor = minor
+        nb.cells = [
+            v4.new_raw_cell('---\ntitle: x\n---', metadata={'tags': []}),
+            v4.new_markdown_cell('# Docs\r\nline 2\n\n', metadata={'tags': ['nbd-docs']},
+                                 attachments={'a.png': {'image/png': png, 'text/plain': 'a\nb'}}),
+            v4.new_code_cell('import x\nx.f()', metadata={'tags': ['nbd-module', 'nbd-docs'], 'trusted': True}, outputs=[
+                v4.new_output('stream', name='stdout', text='line 1\nline 2\n'),
+                v4.new_output('display_data', data={'image/png': png, 'text/plain': '<Figure>', 'image/svg+xml': '<svg>\n</svg>',
+                                                    'application/json': {'a': [1, 'b\n']}}),
+                v4.new_output('execute_result', data={'text/html': ['<b>', 'x</b>\n']}, execution_count=3),
+                v4.new_output('error', ename='E', evalue='e', traceback=['tb']),
+            ]),
+            v4.new_code_cell('secret()', metadata={'tags': ['nbd-module']}, outputs=[
+                v4.new_output('display_data', data={'image/png': png})]),
+            v4.new_code_cell('"\\"tags\\": [\\"nbd-docs\\"]"', outputs=[
+                v4.new_output('stream', name='stdout', text=['{"metadata": {"tags": ["nbd-docs"]}}'])]),
+            v4.new_markdown_cell('no tags'),
+        ]
+        if minor < 5:
+            for c in nb.cells:
+                del c['id']
+        return nbformat.writes(nb)
+
+    nb5 = notebook(5)
+    for text in [notebook(4), nb5, nb5.replace('\n', '\r\n')]:
+        t0 = time.time()
+        res = _filter_docs_json(text)
+        t1 = time.time()
+        assert res == _filter_docs_nbformat(text)
+        print(f'stream filter: {t1 - t0:.3f} seconds, nbformat filter: {time.time() - t1:.3f} seconds')
+        assert len(json.loads(res)['cells']) == 2
+
+    truncated = '{"cells": [{"metadata": {"tags": ["nbd-docs"]}, "source": "abc'
+    try:
+        _filter_docs_json(truncated)
+    except Exception as e:
+        print('Truncated notebook:', repr(e)[:100])
+    else:
+        raise AssertionError('Truncated notebook did not fail.')
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        for i in range(3):
+            (d / 'nbs' / 'sub').mkdir(parents=True, exist_ok=True)
+            (d / 'nbs' / 'sub' / f'{i}.ipynb').write_text(nb5, encoding='utf-8')
+        paths = sorted((d / 'nbs').rglob('*.ipynb'))
+        out = filter_docs_batch(paths, d / 'docs')
+        assert [p.name for p in out] == ['0.ipynb', '1.ipynb', '2.ipynb']
+        assert out[0].read_text(encoding='utf-8') == _filter_docs_nbformat(nb5)
+
+        # command line batch mode with relative paths
+        with contextlib.chdir(d / 'nbs'):
+            main(['filter-docs', '-o', '../cli', 'sub/0.ipynb', 'sub/1.ipynb'])
+            assert (d / 'cli' / 'sub' / '1.ipynb').read_text(encoding='utf-8') == _filter_docs_nbformat(nb5)
+            with contextlib.redirect_stderr(io.StringIO()):
+                try:
+                    main(['filter-docs', 'sub/0.ipynb'])
+                    raise AssertionError('Missing output directory was accepted.')
+                except SystemExit:
+                    pass
+            for args in [['-o', '.', 'sub/0.ipynb'],
+                         ['-o', str(d / 'x'), str(d / 'nbs' / 'sub' / '0.ipynb'), str(d / 'cli' / 'sub' / '0.ipynb')]]:
+                try:
+                    main(['filter-docs'] + args)
+                    raise AssertionError(f'Overwriting output was not detected: {args}')
+                except ValueError as e:
+                    print(e)
+        assert (d / 'nbs' / 'sub' / '0.ipynb').read_text(encoding='utf-8') == nb5
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='nbd.py', description='Notebook development tools.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('filter-docs', help='only keep notebook cells with "nbd-docs" tag')
+    p.add_argument('notebooks', nargs='*', help='notebooks to filter, default is to filter STDIN to STDOUT')
+    p.add_argument('-o', '--out-dir', help='directory for filtered notebooks, required with notebooks')
+    p = sub.add_parser('watch', help='convert notebooks to modules when they are saved')
+    p.add_argument('package', help='package name')
+    p.add_argument('--root', default='.', help='directory at or below project root')
+    p.add_argument('--debounce', type=float, default=0.2, help='seconds to wait for more changes')
+    p.add_argument('--poll', action='store_true', help='check modification times instead of using inotify')
+    args = parser.parse_args(argv)
+    if args.command == 'filter-docs':
+        if args.notebooks:
+            if args.out_dir is None:
+                parser.error('filter-docs: --out-dir is required when notebooks are given')
+            filter_docs_batch(args.notebooks, args.out_dir)
+        else:
+            filter_docs()
+    elif args.command == 'watch':
+        Nbd(args.package, args.root).watch(args.debounce, 'poll' if args.poll else 'auto')
 
 
 if __name__ == '__main__':
-    if sys.argv[1] == 'filter-docs':
-        filter_docs()
+    main()
 
 
 def test_all():
     test_nbd_init()
     test_relative_import()
+    test_nb2script()
     test_nbd_nb2mod()
+    test_nbd_build()
+    test_nbd_watch()
+    test_filter_docs()
 
@@ -1,24 +1,154 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import shutil
-import urllib
+import io
+import os
+import re
+import time
+import hashlib
+import threading
+import contextlib
+import itertools
+import collections
 from pathlib import Path
 from urllib.parse import urlparse, unquote
 from datetime import datetime
 import tempfile
 
-import requests
-import numpy as np
-import pandas as pd
 
+def _format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024:
+            break
+        n /= 1024
+    else:
+        unit = 'TB'
+    return f'{n:.1f} {unit}' if unit != 'B' else f'{n:.0f} B'
+
+def _open_http(url, offset, chunk_size, session=None, validators=None, if_range=None):
+    """Start HTTP download from `offset`, return actual offset, total size, validators and iterator of data chunks.
+    Return None if `validators` are given and the file was not modified.
+    Download is only resumed from `offset` if file still matches `if_range` validator.
+    """
+    import requests
+    get = requests.get if session is None else session.get
+    # identity encoding, so that received bytes match the file and Content-Length
+    headers = {'Accept-Encoding': 'identity'}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = if_range
+    if validators:
+        if 'ETag' in validators:
+            headers['If-None-Match'] = validators['ETag']
+        if 'Last-Modified' in validators:
+            headers['If-Modified-Since'] = validators['Last-Modified']
+    r = get(url, headers=headers, stream=True, timeout=60)
+    if r.status_code == 304:
+        r.close()
+        return None
+    if r.status_code == 416:
+        # range not satisfiable, partial file is not usable
+        r.close()
+        return _open_http(url, 0, chunk_size, session, validators)
+    r.raise_for_status()
+    if r.status_code != 206:
+        offset = 0
+    length = r.headers.get('Content-Length')
+    total = None if length is None else offset + int(length)
+    new_validators = {k: r.headers[k] for k in ['ETag', 'Last-Modified'] if k in r.headers}
+    def chunks():
+        with r:
+            yield from r.iter_content(chunk_size)
+    return offset, total, new_validators, chunks()
+
+def _open_ftp(url, offset, chunk_size, validators=None, if_range=None):
+    """Start FTP download from `offset`, return actual offset, total size, validators and iterator of data chunks.
+    Return None if `validators` are given and the file was not modified.
+    Download is only resumed from `offset` if file modification time still matches `if_range`.
+    """
+    import ftplib
+    u = urlparse(url)
+    path = unquote(u.path)
+    ftp = ftplib.FTP(timeout=60)
+    ftp.connect(u.hostname, u.port or 21)
+    ftp.login(unquote(u.username or 'anonymous'), unquote(u.password or ''))
+    ftp.voidcmd('TYPE I')
+    try:
+        total = ftp.size(path)
+    except ftplib.all_errors:
+        total = None
+    try:
+        # modification time as YYYYMMDDHHMMSS
+        new_validators = {'Last-Modified': ftp.sendcmd(f'MDTM {path}')[4:].strip()}
+    except ftplib.all_errors:
+        new_validators = {}
+    if validators and new_validators and validators.get('Last-Modified') == new_validators['Last-Modified']:
+        ftp.quit()
+        return None
+    if new_validators.get('Last-Modified') != if_range:
+        offset = 0
+    try:
+        conn = ftp.transfercmd(f'RETR {path}', offset or None)
+    except (ftplib.error_perm, ftplib.error_reply):
+        if not offset:
+            raise
+        # server does not support REST
+        offset = 0
+        conn = ftp.transfercmd(f'RETR {path}')
+    def chunks():
+        with ftp:
+            with conn:
+                while chunk := conn.recv(chunk_size):
+                    yield chunk
+            ftp.voidresp()
+    return offset, total, new_validators, chunks()
+
+def _read_info(finfo):
+    """Return dict of fields from download info file, empty if file does not exist."""
+    try:
+        lines = Path(finfo).read_text().splitlines()
+    except FileNotFoundError:
+        return {}
+    return dict(line.split(': ', 1) for line in lines if ': ' in line)
+
+def _write_info(finfo, info):
+    with open(finfo, 'w') as f:
+        for k, v in info.items():
+            f.write(f'{k}: {v}\n')
 
-def download_file(url, dir=None, fname=None, overwrite=False, save_info=True):
+def _store_path(store, hash_name, digest):
+    return Path(store).resolve() / hash_name / digest[:2] / digest
+
+def _link(src, dst, link):
+    """Replace `dst` with a hard or symbolic link to `src`."""
+    tmp = dst.with_name(dst.name + '.link')
+    tmp.unlink(missing_ok=True)
+    if link == 'hard':
+        try:
+            os.link(src, tmp)
+        except OSError:
+            # store is on another file system
+            os.symlink(src, tmp)
+    elif link == 'symbolic':
+        os.symlink(src, tmp)
+    else:
+        raise ValueError(f'Unknown link type "{link}".')
+    os.replace(tmp, dst)
+
+def download_file(url, dir=None, fname=None, overwrite=False, save_info=True, checksum=None, resume=True,
+                  chunk_size=2**20, session=None, revalidate=False, store=None, link='hard'):
     """Download file from given `url` and put it into `dir`.
     Current working directory is used as default. Missing directories are created.
     File name from `url` is used as default.
     Return absolute pathlib.Path of the downloaded file.
     Supports HTTP and FTP protocols.
+    
+    Unfinished download is kept in "<fname>.part" file and continued on next call if `resume` is True.
+    `checksum` is hash algorithm name or "algorithm:expected_hex_digest".
+    HTTP requests are sent through `requests.Session` object if `session` is given.
+    If `revalidate` is True, existing file is downloaded again only if it was changed on the server.
+    If `store` directory is given, file is kept there under its checksum and linked into `dir`.
+    `link` is "hard" or "symbolic".
     """
     
     if dir is None:
@@ -29,36 +159,107 @@ def download_file(url, dir=None, fname=None, overwrite=False, save_info=True):
     if fname is None:
         fname = unquote(Path(urlparse(url).path).name)
     fpath = dpath / fname
+    finfo = dpath / (fname + '_info.txt')
     
+    validators = None
     if not overwrite and fpath.exists():
-        print(f'File {fname} already exists.')
-        return fpath
+        if not revalidate:
+            print(f'File {fname} already exists.')
+            return fpath
+        info = _read_info(finfo)
+        validators = {k: info[k] for k in ['ETag', 'Last-Modified'] if k in info}
 
+    hash_name, _, expected_digest = (checksum or '').partition(':')
+    if store is not None:
+        hash_name = hash_name or 'sha256'
     access_time = datetime.utcnow().isoformat(' ', timespec='seconds')
-    
+    info = {'File path': fpath, 'File size (bytes)': None, 'Download URL': url, 'Access time': f'{access_time} UTC'}
+
+    if store is not None and expected_digest:
+        stored = _store_path(store, hash_name, expected_digest.lower())
+        if stored.exists():
+            _link(stored, fpath, link)
+            if save_info:
+                info['File size (bytes)'] = f'{stored.stat().st_size:,d}'
+                info[f'Checksum ({hash_name})'] = expected_digest.lower()
+                info['Store path'] = stored
+                _write_info(finfo, info)
+            print(f'File {fname} linked from store.')
+            return fpath
+
+    part = dpath / (fname + '.part')
+    part_info = dpath / (fname + '.part_info.txt')
+    offset = part.stat().st_size if resume and part.exists() else 0
+    # resume only if it can be checked that partial file is from the same version
+    part_validators = _read_info(part_info)
+    if_range = part_validators.get('ETag', part_validators.get('Last-Modified'))
+    if if_range is None:
+        offset = 0
+
+    t0 = time.perf_counter()
     if urlparse(url).scheme == 'ftp':
-        with urllib.request.urlopen(url) as r:
-            with open(fpath, 'wb') as f:
-                shutil.copyfileobj(r, f)
+        opened = _open_ftp(url, offset, chunk_size, validators, if_range)
     else:
-        with requests.get(url) as r:
-            r.raise_for_status()
-            with open(fpath, 'wb') as f:
-                f.write(r.content)
+        opened = _open_http(url, offset, chunk_size, session, validators, if_range)
+    if opened is None:
+        part.unlink(missing_ok=True)
+        part_info.unlink(missing_ok=True)
+        print(f'File {fname} is up to date.')
+        return fpath
+    offset, total, validators, chunks = opened
+    if offset == 0:
+        _write_info(part_info, validators)
+    h = hashlib.new(hash_name) if hash_name else None
+    received = 0
+    with open(part, 'r+b' if offset else 'w+b') as f:
+        if h is not None:
+            while data := f.read(chunk_size):
+                h.update(data)
+        f.seek(offset)
+        f.truncate()
+        for data in chunks:
+            f.write(data)
+            received += len(data)
+            if h is not None:
+                h.update(data)
+    elapsed = time.perf_counter() - t0
+
+    fsz = offset + received
+    if total is not None and fsz != total:
+        raise IOError(f'Download of "{url}" is incomplete: received {fsz:,d} of {total:,d} bytes.')
+    digest = None if h is None else h.hexdigest()
+    part_info.unlink(missing_ok=True)
+    if expected_digest and digest != expected_digest.lower():
+        part.unlink()
+        raise ValueError(f'Checksum mismatch for "{url}": expected {expected_digest}, got {digest}.')
+    if store is None:
+        os.replace(part, fpath)
+    else:
+        stored = _store_path(store, hash_name, digest)
+        if stored.exists():
+            part.unlink()
+        else:
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            # shared content must not be modified in place
+            part.chmod(0o444)
+            os.replace(part, stored)
+        _link(stored, fpath, link)
                 
     if save_info:
-        finfo = dpath / (fname + '_info.txt')
-        with open(finfo, 'w') as f:
-            f.write(f'File path: {fpath}\n')
-            fsz = fpath.stat().st_size
-            f.write(f'File size (bytes): {fsz:,d}\n')
-            f.write(f'Download URL: {url}\n')
-            f.write(f'Access time: {access_time} UTC\n')
+        info['File size (bytes)'] = f'{fsz:,d}'
+        if digest is not None:
+            info[f'Checksum ({hash_name})'] = digest
+        info.update(validators)
+        if store is not None:
+            info['Store path'] = stored
+        _write_info(finfo, info)
     
-    print(f'Downloaded file "{fname}".')
+    speed = received / elapsed if elapsed > 0 else 0
+    resumed = f', resumed at {_format_bytes(offset)}' if offset else ''
+    print(f'Downloaded file "{fname}": {_format_bytes(received)} in {elapsed:.1f} seconds, '
+          f'{_format_bytes(speed)}/s{resumed}.')
     return fpath 
 
-
 def test_download_file():
     with tempfile.TemporaryDirectory() as temp_dir:
         print('Testing FTP download')
@@ -74,6 +275,264 @@ def test_download_file():
         assert cloned_file.open().read() == downloaded_file.open().read()
 
 
+class _TestServer:
+    """HTTP server on localhost serving `files` dict of {path: bytes}."""
+    def __init__(self, files):
+        import http.server
+        self.files = files
+        self.truncate = {}
+        self.delay = 0
+        self.log = []
+        self.active = self.max_active = 0
+        self._lock = threading.Lock()
+        server = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                server._get(self)
+            def log_message(self, *args):
+                pass
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _get(self, h):
+        with self._lock:
+            self.log.append((h.path, dict(h.headers), h.client_address))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            self._send(h)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def _send(self, h):
+        data = self.files.get(h.path)
+        if data is None:
+            h.send_error(404)
+            return
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        if h.headers.get('If-Range', etag) != etag:
+            del h.headers['Range']
+        if h.headers.get('If-None-Match') == etag:
+            h.send_response(304)
+            h.send_header('ETag', etag)
+            h.end_headers()
+            return
+        start = 0
+        m = re.fullmatch(r'bytes=(\d+)-', h.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            if start >= len(data):
+                h.send_error(416)
+                return
+            h.send_response(206)
+            h.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        else:
+            h.send_response(200)
+        h.send_header('Content-Length', str(len(data) - start))
+        h.send_header('ETag', etag)
+        h.end_headers()
+        body = data[start:]
+        if h.path in self.truncate:
+            body = body[:self.truncate.pop(h.path)]
+            h.close_connection = True
+        h.wfile.write(body)
+
+def test_download_file_resume():
+    data = os.urandom(3 * 2**20 + 123)
+    digest = hashlib.sha256(data).hexdigest()
+    with _TestServer({'/data.bin': data}) as server, tempfile.TemporaryDirectory() as d:
+        url = server.url + '/data.bin'
+        fpath = Path(d, 'data.bin')
+        part = Path(d, 'data.bin.part')
+
+        server.truncate['/data.bin'] = 2**20 + 5
+        try:
+            download_file(url, d, checksum='sha256:' + digest)
+        except Exception as e:
+            print('Interrupted download:', repr(e)[:100])
+        else:
+            raise AssertionError('Truncated download did not fail.')
+        assert not fpath.exists()
+        offset = part.stat().st_size
+        assert 0 < offset < len(data)
+
+        assert download_file(url, d, checksum='sha256:' + digest) == fpath
+        assert server.log[-1][1]['Range'] == f'bytes={offset}-'
+        assert fpath.read_bytes() == data
+        assert not part.exists()
+        assert f'Checksum (sha256): {digest}' in Path(d, 'data.bin_info.txt').read_text()
+
+        # file changed on the server before download was resumed
+        server.truncate['/data.bin'] = 2**20
+        with contextlib.suppress(Exception):
+            download_file(url, d, overwrite=True)
+        assert part.exists()
+        server.files['/data.bin'] = data2 = os.urandom(len(data))
+        download_file(url, d, overwrite=True)
+        assert 'If-Range' in server.log[-1][1]
+        assert not Path(d, 'data.bin.part_info.txt').exists()
+        assert fpath.read_bytes() == data2
+
+        try:
+            download_file(url, d, 'bad.bin', checksum='sha256:' + '0' * 64)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Checksum mismatch was not detected.')
+        assert not Path(d, 'bad.bin').exists() and not Path(d, 'bad.bin.part').exists()
+
+def test_download_file_revalidate():
+    data = os.urandom(100_000)
+    with _TestServer({'/a.bin': data}) as server, tempfile.TemporaryDirectory() as d:
+        url = server.url + '/a.bin'
+        fpath = download_file(url, d)
+        etag = _read_info(Path(d, 'a.bin_info.txt'))['ETag']
+
+        download_file(url, d, revalidate=True)
+        assert server.log[-1][1]['If-None-Match'] == etag
+        assert len(server.log) == 2 and fpath.read_bytes() == data
+
+        server.files['/a.bin'] = data = os.urandom(50_000)
+        download_file(url, d, revalidate=True)
+        assert fpath.read_bytes() == data
+        assert _read_info(Path(d, 'a.bin_info.txt'))['ETag'] != etag
+
+def test_download_file_store():
+    data = os.urandom(100_000)
+    digest = hashlib.sha256(data).hexdigest()
+    with _TestServer({'/a.bin': data}) as server, tempfile.TemporaryDirectory() as d:
+        url = server.url + '/a.bin'
+        store = Path(d, 'store')
+        stored = store / 'sha256' / digest[:2] / digest
+        f1 = download_file(url, f'{d}/p1', store=store)
+        f2 = download_file(url, f'{d}/p2', store=store)
+        assert [p for p in store.rglob('*') if p.is_file()] == [stored]
+        assert f1.stat().st_ino == f2.stat().st_ino == stored.stat().st_ino
+        assert _read_info(f'{d}/p1/a.bin_info.txt')['Store path'] == str(stored)
+
+        # content is already in store, no request is needed
+        f3 = download_file(url, f'{d}/p3', store=store, link='symbolic', checksum='sha256:' + digest)
+        assert len(server.log) == 2
+        assert f3.is_symlink() and f3.read_bytes() == data
+
+        # new version replaces the link, stored file is not changed
+        server.files['/a.bin'] = os.urandom(50_000)
+        download_file(url, f'{d}/p1', revalidate=True, store=store)
+        assert f1.read_bytes() == server.files['/a.bin']
+        assert f2.read_bytes() == data and stored.read_bytes() == data
+
+
+Download = collections.namedtuple('Download', 'url path error')
+
+def _retryable(e):
+    """Return True if download error `e` is likely transient."""
+    import ftplib
+    import requests
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (e.response.status_code == 429 or e.response.status_code >= 500)
+    return isinstance(e, (OSError, EOFError, ftplib.error_temp))
+
+def download_many(urls, dir=None, workers=8, per_host=4, retries=3, backoff=1, overwrite=False, **kwargs):
+    """Download `urls` into `dir` concurrently, yield `Download` tuples as downloads finish.
+    At most `per_host` files are downloaded from the same host at once.
+    Failed downloads are retried `retries` times, waiting `backoff * 2**attempt` seconds before each retry.
+    Other keyword arguments are passed to `download_file()`, except `fname` and `session`,
+    because file name is taken from each URL and every thread uses its own session.
+    """
+    import concurrent.futures
+    import requests
+
+    for k in ['fname', 'session']:
+        if k in kwargs:
+            raise TypeError(f'download_many() does not accept "{k}" argument.')
+
+    dpath = Path('.' if dir is None else dir).resolve()
+    urls = list(dict.fromkeys(urls))
+    limits = {urlparse(u).netloc: threading.Semaphore(per_host) for u in urls}
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=len(limits), pool_maxsize=per_host)
+            local.session.mount('http://', adapter)
+            local.session.mount('https://', adapter)
+        return local.session
+
+    def fetch(url):
+        for attempt in itertools.count():
+            try:
+                with limits[urlparse(url).netloc]:
+                    return download_file(url, dpath, overwrite=overwrite, session=session(), **kwargs)
+            except Exception as e:
+                if attempt >= retries or not _retryable(e):
+                    raise
+                pause = backoff * 2**attempt
+                print(f'Download of "{url}" failed: {e!r}, retrying in {pause} seconds.')
+                time.sleep(pause)
+
+    with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='download') as pool:
+        futures = {}
+        for url in urls:
+            fpath = dpath / unquote(Path(urlparse(url).path).name)
+            if not overwrite and not kwargs.get('revalidate') and fpath.exists():
+                yield Download(url, fpath, None)
+            else:
+                futures[pool.submit(fetch, url)] = url
+        try:
+            for f in concurrent.futures.as_completed(futures):
+                e = f.exception()
+                yield Download(futures[f], None if e else f.result(), e)
+        finally:
+            for f in futures:
+                f.cancel()
+
+def test_download_many():
+    files = {f'/f{i}.bin': os.urandom(100_000 + i) for i in range(20)}
+    with _TestServer(files) as server, tempfile.TemporaryDirectory() as d:
+        Path(d, 'f0.bin').write_bytes(files['/f0.bin'])
+        server.delay = 0.2
+        server.truncate['/f1.bin'] = 5000
+        urls = [server.url + p for p in files] + [server.url + '/missing.bin']
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = list(download_many(urls, d, workers=8, per_host=4, backoff=0.1))
+        elapsed = time.perf_counter() - t0
+        print(f'Downloaded {len(files)} files in {elapsed:.2f} seconds, {len(server.log)} requests, '
+              f'{len({x[2] for x in server.log})} connections.')
+
+        assert len(results) == len(urls)
+        res = {urlparse(r.url).path: r for r in results}
+        assert isinstance(res['/missing.bin'].error, Exception)
+        for k in ['fname', 'session']:
+            try:
+                list(download_many(urls, d, **{k: None}))
+                raise AssertionError(f'"{k}" argument was accepted.')
+            except TypeError:
+                pass
+        for p, data in files.items():
+            assert res[p].error is None and res[p].path.read_bytes() == data
+        paths = [x[0] for x in server.log]
+        assert '/f0.bin' not in paths
+        assert paths.count('/f1.bin') == 2
+        assert server.max_active == 4
+        # each request takes 0.2 seconds, 4 run at a time
+        assert elapsed < 0.2 * len(paths) / 2
+        # connections are reused
+        assert len({x[2] for x in server.log}) < len(paths)
+
+
 def tag_invalid_values(ser, notna=False, unique=False, nchar=None, number=False, cats=None,
                  eq=None, gt=None, ge=None, lt=None, le=None):
     """Return array with indicators of invalid values in `ser`.
@@ -87,6 +546,8 @@ def tag_invalid_values(ser, notna=False, unique=False, nchar=None, number=False,
     `unique` will tag all duplicates as invalid.
     """
     # idea: print warning if unsupported values are present, e.g. str values with "ge" flag
+    import numpy as np
+    import pandas as pd
     valid = np.ones_like(ser, bool)
     ser_isna = ser.isna()
     ser_notna = ~ser_isna
@@ -136,6 +597,8 @@ def validate_values(df, constraints):
     return invalid_list
 
 def test_tag_invalid_values():
+    import numpy as np
+    import pandas as pd
     s = pd.Series(['alpha', 'beta', 'beta', '0123', np.nan], dtype='str')
     assert (tag_invalid_values(s, notna=True) == [False, False, False, False, True]).all()
     assert (tag_invalid_values(s, unique=True) == [False, True, True, False, False]).all()
@@ -169,6 +632,7 @@ def group_exampler(group_col, sort_col=None):
             example_pool = df.query(query)[group_col].values
         if len(example_pool) == 0:
             return f'No groups found for query="{query}", all={all}'
+        import numpy as np
         example_group = np.random.choice(example_pool)
         example_df = df[df[group_col] == example_group]
         if sort_col is not None:
@@ -179,5 +643,9 @@ def group_exampler(group_col, sort_col=None):
 
 def test_all():
     test_download_file()
+    test_download_file_resume()
+    test_download_file_revalidate()
+    test_download_file_store()
+    test_download_many()
     test_tag_invalid_values()
 